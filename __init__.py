@@ -5,29 +5,41 @@ from .configuration import *
 from . import period
 from . import company 
 from . import report
+from . import balance
 
 def register():
     Pool.register(
     	group.TmiMetaGroup, 
         group.TmiGroup,
         group.TmiGroupStatisticalContext, 
+        group.ExportBalanceSheetStart,
         Move, 
         Line,
         Configuration,
         ConfigurationSequence, 
         ConfigurationTarget, 
         QuoteMoveDefault,
+        ImportLinesStart,
+        ImportLinesResult,
         period.Year,
         period.Period,
+        balance.TmiMetaGroupSnapshot,
+        balance.TmiMetaGroupBalance,
+        balance.TmiGroupBalance,
+        period.OpenMovesStart,
         company.Company,  
         report.PrintTmiReportStart, 
         module='tmi', type_='model')
 
     Pool.register(
         QuoteMove,
+        ImportLines,
+        group.ExportBalanceSheet,
+        period.OpenMoves,
         report.PrintTmiReport, 
         module='tmi', type_='wizard')
 
     Pool.register(
         report.TmiReport, 
+        group.BalanceSheetReport,
         module='tmi', type_='report') 
\ No newline at end of file
@@ -0,0 +1,609 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from decimal import Decimal
+
+from sql import Column, Literal
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, fields, Unique
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['TmiMetaGroupBalance', 'TmiMetaGroupSnapshot', 'TmiGroupBalance']
+
+BALANCE_FIELDS = ['baptism', 'small_group', 'tithe', 'offering',
+    'praise_thanksgiving', 'gathering', 'church_planting',
+    'organizing_church']
+
+
+class BalanceMixin(object):
+    '''
+    Metric sums of the move lines kept per key, period and posted state.
+    _key is the name of the key column.
+    '''
+    _key = None
+    period = fields.Many2One('tmi.period', 'Period', required=True,
+        select=True, readonly=True, ondelete='CASCADE')
+    posted = fields.Boolean('Posted', readonly=True)
+    baptism = fields.Numeric('Baptism', digits=(16, 2), readonly=True)
+    small_group = fields.Numeric('Small Group', digits=(16, 2),
+        readonly=True)
+    tithe = fields.Numeric('Tithe', digits=(16, 2), readonly=True)
+    offering = fields.Numeric('Offering', digits=(16, 2), readonly=True)
+    praise_thanksgiving = fields.Numeric('Praise and Thanksgiving',
+        digits=(16, 2), readonly=True)
+    gathering = fields.Numeric('Gathering', digits=(16, 2), readonly=True)
+    church_planting = fields.Numeric('Church Planting', digits=(16, 2),
+        readonly=True)
+    organizing_church = fields.Numeric('Organizing Church', digits=(16, 2),
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(BalanceMixin, cls).__setup__()
+        cls.__rpc__.update({
+                'check': RPC(),
+                'repair': RPC(readonly=False),
+                })
+        cls._error_messages.update({
+                'modify_closed_period': ('You can not modify the balances '
+                    'of period "%s" because it is closed.'),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        created = not TableHandler.table_exist(cls._table)
+
+        super(BalanceMixin, cls).__register__(module_name)
+
+        # Migration: fill the sums from the existing lines
+        if created:
+            cls.rebuild()
+
+    @staticmethod
+    def default_posted():
+        return False
+
+    @classmethod
+    def get_sums(cls, where):
+        '''
+        Return the metric sums of the move lines matching where keyed by
+        (key, period, posted).
+        '''
+        raise NotImplementedError
+
+    @staticmethod
+    def _row2sums(rows, sums=None):
+        if sums is None:
+            sums = {}
+        for row in rows:
+            key = (row[0], row[1], bool(row[2]))
+            values = sums.setdefault(key, [Decimal(0)] * len(BALANCE_FIELDS))
+            for i, value in enumerate(row[3:]):
+                # SQLite uses float for SUM
+                if not isinstance(value, Decimal):
+                    value = Decimal(str(value))
+                values[i] += value
+        return sums
+
+    @classmethod
+    def _get_sums_by(cls, column, ids):
+        sums = {}
+        for sub_ids in grouped_slice(ids):
+            for key, values in cls.get_sums(
+                    reduce_ids(column, sub_ids)).items():
+                if key in sums:
+                    values = [a + b for a, b in zip(sums[key], values)]
+                sums[key] = values
+        return sums
+
+    @classmethod
+    def get_line_sums(cls, lines):
+        MoveLine = Pool().get('tmi.move.line')
+        line = MoveLine.__table__()
+        return cls._get_sums_by(line.id, [l.id for l in lines])
+
+    @classmethod
+    def get_move_sums(cls, moves):
+        MoveLine = Pool().get('tmi.move.line')
+        line = MoveLine.__table__()
+        return cls._get_sums_by(line.move, [m.id for m in moves])
+
+    @classmethod
+    def update_sums(cls, before, after, check_periods=True):
+        '''
+        Apply the difference between the sums computed before and after a
+        modification of the move lines.
+        If check_periods is set, the periods of the differences must be open
+        because the balances of the closed periods are frozen.
+        '''
+        deltas = {}
+        for key in set(before) | set(after):
+            old = before.get(key, [Decimal(0)] * len(BALANCE_FIELDS))
+            new = after.get(key, [Decimal(0)] * len(BALANCE_FIELDS))
+            delta = [n - o for o, n in zip(old, new)]
+            if any(delta):
+                deltas[key] = delta
+        if deltas:
+            if check_periods:
+                cls.check_periods({k[1] for k in deltas})
+            cls._apply_sums(deltas)
+
+    @classmethod
+    def check_periods(cls, period_ids):
+        'Check that the periods are not closed'
+        Period = Pool().get('tmi.period')
+        for period in Period.browse(list(period_ids)):
+            if period.state != 'open':
+                cls.raise_user_error('modify_closed_period',
+                    (period.rec_name,))
+
+    @classmethod
+    def _apply_sums(cls, deltas):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        key_column = Column(table, cls._key)
+
+        existing = {}
+        key_ids = list({k[0] for k in deltas})
+        period_ids = list({k[1] for k in deltas})
+        for sub_ids in grouped_slice(key_ids):
+            cursor.execute(*table.select(
+                    table.id, key_column, table.period, table.posted,
+                    where=reduce_ids(key_column, sub_ids)
+                    & reduce_ids(table.period, period_ids)))
+            for id_, key_id, period_id, posted in cursor.fetchall():
+                existing[(key_id, period_id, bool(posted))] = id_
+
+        to_insert = []
+        for key, delta in deltas.items():
+            if key in existing:
+                cursor.execute(*table.update(
+                        columns=[Column(table, n) for n in BALANCE_FIELDS],
+                        values=[Coalesce(Column(table, n), 0) + d
+                            for n, d in zip(BALANCE_FIELDS, delta)],
+                        where=table.id == existing[key]))
+            else:
+                key_id, period_id, posted = key
+                to_insert.append([transaction.user, CurrentTimestamp(),
+                        key_id, period_id, posted] + delta)
+        if to_insert:
+            columns = [table.create_uid, table.create_date, key_column,
+                table.period, table.posted]
+            columns += [Column(table, n) for n in BALANCE_FIELDS]
+            for sub_values in grouped_slice(to_insert):
+                cursor.execute(*table.insert(columns, list(sub_values)))
+
+    @classmethod
+    def rebuild(cls):
+        'Recompute all the sums from the move lines'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.delete())
+        sums = cls.get_sums(Literal(True))
+        if sums:
+            cls._apply_sums(sums)
+
+    @classmethod
+    def get_stored_sums(cls):
+        '''
+        Return the stored sums keyed by (key, period, posted)
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.select(Column(table, cls._key), table.period,
+                table.posted,
+                *[Coalesce(Column(table, n), 0) for n in BALANCE_FIELDS]))
+        return cls._row2sums(cursor.fetchall())
+
+    @classmethod
+    def _get_drift(cls):
+        expected = cls.get_sums(Literal(True))
+        stored = cls.get_stored_sums()
+        drift = {}
+        for key in set(expected) | set(stored):
+            old = stored.get(key, [Decimal(0)] * len(BALANCE_FIELDS))
+            new = expected.get(key, [Decimal(0)] * len(BALANCE_FIELDS))
+            delta = [n - o for o, n in zip(old, new)]
+            if any(delta):
+                drift[key] = delta
+        return drift
+
+    @classmethod
+    def _drift2list(cls, drift):
+        result = []
+        for (key_id, period_id, posted), delta in sorted(drift.items()):
+            values = {
+                cls._key: key_id,
+                'period': period_id,
+                'posted': posted,
+                }
+            values.update(zip(BALANCE_FIELDS, delta))
+            result.append(values)
+        return result
+
+    @classmethod
+    def check(cls):
+        '''
+        Compare the stored sums with the sums of the move lines and return
+        the differences as a list of dictionaries
+        '''
+        return cls._drift2list(cls._get_drift())
+
+    @classmethod
+    def repair(cls):
+        '''
+        Apply to the stored sums their differences with the move lines and
+        return them like check
+        '''
+        drift = cls._get_drift()
+        if drift:
+            cls._apply_sums(drift)
+        return cls._drift2list(drift)
+
+
+class TmiMetaGroupBalance(BalanceMixin, ModelSQL, ModelView):
+    'Meta Group Balance'
+    __name__ = 'tmi.meta.group.balance'
+    _key = 'meta'
+
+    meta = fields.Many2One('tmi.meta.group', 'Meta Group', required=True,
+        select=True, readonly=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super(TmiMetaGroupBalance, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('meta_period_posted_uniq', Unique(t, t.meta, t.period, t.posted),
+                'The balance must be unique per meta group, period '
+                'and posted state.'),
+            ]
+
+    @classmethod
+    def get_sums(cls, where):
+        '''
+        Return the metric sums of the move lines matching where, rolled up
+        to every meta group ancestor and keyed by (meta, period, posted).
+        '''
+        pool = Pool()
+        Meta = pool.get('tmi.meta.group')
+        Group = pool.get('tmi.group')
+        MoveLine = pool.get('tmi.move.line')
+        line = MoveLine.__table__()
+        group = Group.__table__()
+        meta = Meta.__table__()
+        child = Meta.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = [meta.id, line.period, line.posted]
+        for name in BALANCE_FIELDS:
+            columns.append(Sum(Coalesce(Column(line, name), 0)))
+        cursor.execute(*line.join(group, condition=line.group == group.id
+                ).join(child, condition=group.meta == child.id
+                ).join(meta,
+                condition=(child.left >= meta.left)
+                & (child.right <= meta.right)
+                ).select(*columns,
+                where=where & (line.state != 'draft'),
+                group_by=[meta.id, line.period, line.posted]))
+        return cls._row2sums(cursor.fetchall())
+
+    @classmethod
+    def get_group_sums(cls, groups):
+        MoveLine = Pool().get('tmi.move.line')
+        line = MoveLine.__table__()
+        return cls._get_sums_by(line.group, [g.id for g in groups])
+
+    @classmethod
+    def get_meta_sums(cls, metas):
+        'Return the sums of the lines of the groups under the meta groups'
+        Group = Pool().get('tmi.group')
+        with Transaction().set_context(active_test=False):
+            groups = Group.search([
+                    ('meta', 'child_of', [m.id for m in metas], 'parent'),
+                    ])
+        return cls.get_group_sums(groups)
+
+    @classmethod
+    def _apply_sums(cls, deltas):
+        from .engine import HierarchyEngine
+        HierarchyEngine.invalidate({k[1] for k in deltas})
+        super(TmiMetaGroupBalance, cls)._apply_sums(deltas)
+
+    @classmethod
+    def rebuild(cls):
+        from .engine import HierarchyEngine
+        super(TmiMetaGroupBalance, cls).rebuild()
+        HierarchyEngine.clear()
+
+    @classmethod
+    def _get_context_periods(cls):
+        '''
+        Return the periods touched by the context or None if the context
+        selects the moves by date.
+        '''
+        pool = Pool()
+        Period = pool.get('tmi.period')
+        context = Transaction().context
+
+        if context.get('date'):
+            return None
+        from_date, to_date = context.get('from_date'), context.get('to_date')
+        year_id = context.get('year')
+        period_ids = context.get('periods')
+
+        domain = []
+        if year_id or period_ids or from_date or to_date:
+            if year_id:
+                domain.append(('year', '=', year_id))
+            if period_ids:
+                domain.append(('id', 'in', period_ids))
+            if from_date:
+                domain.append(('end_date', '>=', from_date))
+            if to_date:
+                domain.append(('start_date', '<=', to_date))
+        else:
+            domain.append(('year.state', '=', 'open'))
+        return Period.search(domain)
+
+    @classmethod
+    def _period_covered(cls, period):
+        'Test if the context selects the whole period'
+        context = Transaction().context
+        from_date, to_date = context.get('from_date'), context.get('to_date')
+        if from_date and period.start_date < from_date:
+            return False
+        if to_date and period.end_date > to_date:
+            return False
+        return True
+
+    @classmethod
+    def get_context_periods(cls):
+        '''
+        Return the ids of the periods selected by the context or None if the
+        context does not align on period boundaries.
+        '''
+        periods = cls._get_context_periods()
+        if periods is None:
+            return None
+        if not all(cls._period_covered(p) for p in periods):
+            return None
+        return [p.id for p in periods]
+
+    @classmethod
+    def query_get(cls, table, period_ids):
+        '''
+        Return SQL clause for the rollup rows of the periods
+        table is the SQL instance of tmi.meta.group.balance table
+        '''
+        where = reduce_ids(table.period, period_ids)
+        if Transaction().context.get('posted'):
+            where &= table.posted == Literal(True)
+        return where
+
+
+class TmiMetaGroupSnapshot(ModelSQL, ModelView):
+    'Meta Group Snapshot'
+    __name__ = 'tmi.meta.group.snapshot'
+
+    meta = fields.Many2One('tmi.meta.group', 'Meta Group', required=True,
+        select=True, readonly=True, ondelete='CASCADE')
+    period = fields.Many2One('tmi.period', 'Period', required=True,
+        select=True, readonly=True, ondelete='CASCADE')
+    posted = fields.Boolean('Posted', readonly=True)
+    baptism = fields.Numeric('Baptism', digits=(16, 2), readonly=True)
+    small_group = fields.Numeric('Small Group', digits=(16, 2),
+        readonly=True)
+    tithe = fields.Numeric('Tithe', digits=(16, 2), readonly=True)
+    offering = fields.Numeric('Offering', digits=(16, 2), readonly=True)
+    praise_thanksgiving = fields.Numeric('Praise and Thanksgiving',
+        digits=(16, 2), readonly=True)
+    gathering = fields.Numeric('Gathering', digits=(16, 2), readonly=True)
+    church_planting = fields.Numeric('Church Planting', digits=(16, 2),
+        readonly=True)
+    organizing_church = fields.Numeric('Organizing Church', digits=(16, 2),
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TmiMetaGroupSnapshot, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('meta_period_posted_uniq', Unique(t, t.meta, t.period, t.posted),
+                'The snapshot must be unique per meta group, period '
+                'and posted state.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Period = pool.get('tmi.period')
+        Balance = pool.get('tmi.meta.group.balance')
+        TableHandler = backend.get('TableHandler')
+        created = not TableHandler.table_exist(cls._table)
+
+        super(TmiMetaGroupSnapshot, cls).__register__(module_name)
+
+        # Migration: freeze the periods already closed
+        # (the rollup takes them when it is created after the snapshots)
+        if created and TableHandler.table_exist(Balance._table):
+            cursor = Transaction().connection.cursor()
+            period = Period.__table__()
+            cursor.execute(*period.select(period.id,
+                    where=period.state != 'open'))
+            cls.take(Period.browse([p for p, in cursor.fetchall()]))
+
+    @staticmethod
+    def default_posted():
+        return False
+
+    @classmethod
+    def take(cls, periods):
+        '''
+        Freeze the balances of every meta group for the periods
+        '''
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        balance = Balance.__table__()
+
+        cls.drop(periods)
+        columns = [table.create_uid, table.create_date, table.meta,
+            table.period, table.posted]
+        columns += [Column(table, n) for n in BALANCE_FIELDS]
+        values = [Literal(transaction.user), CurrentTimestamp(),
+            balance.meta, balance.period, balance.posted]
+        values += [Coalesce(Column(balance, n), 0) for n in BALANCE_FIELDS]
+        for sub_ids in grouped_slice([p.id for p in periods]):
+            cursor.execute(*table.insert(columns,
+                    balance.select(*values,
+                        where=reduce_ids(balance.period, sub_ids))))
+
+    @classmethod
+    def drop(cls, periods):
+        'Remove the snapshots of the periods'
+        from .engine import HierarchyEngine
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        HierarchyEngine.invalidate([p.id for p in periods])
+        for sub_ids in grouped_slice([p.id for p in periods]):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.period, sub_ids)))
+
+    @classmethod
+    def get_frozen_periods(cls, periods):
+        'Return the ids of the periods which have snapshots'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        period_ids = set()
+        for sub_ids in grouped_slice([p.id for p in periods]):
+            cursor.execute(*table.select(table.period,
+                    where=reduce_ids(table.period, sub_ids),
+                    group_by=table.period))
+            period_ids.update(p for p, in cursor.fetchall())
+        return period_ids
+
+    @classmethod
+    def get_closed_periods(cls, period_ids=None):
+        '''
+        Return the ids of the closed periods among period_ids or entirely
+        selected by the context
+        '''
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        Period = pool.get('tmi.period')
+        if period_ids is not None:
+            return [p.id for p in Period.browse(period_ids)
+                if p.state != 'open']
+        periods = Balance._get_context_periods() or []
+        return [p.id for p in periods
+            if p.state != 'open' and Balance._period_covered(p)]
+
+    @classmethod
+    def get_sums(cls, ids, names, period_ids):
+        '''
+        Return the frozen balances of names for the meta group ids
+        '''
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        result = dict((n, {}) for n in names)
+        if not period_ids:
+            return result
+        columns = [table.meta]
+        for name in names:
+            columns.append(Sum(Coalesce(Column(table, name), 0)))
+        where = Balance.query_get(table, period_ids)
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(*columns,
+                    where=where & reduce_ids(table.meta, sub_ids),
+                    group_by=table.meta))
+            for row in cursor.fetchall():
+                for i, name in enumerate(names, 1):
+                    # SQLite uses float for SUM
+                    value = row[i]
+                    if not isinstance(value, Decimal):
+                        value = Decimal(str(value))
+                    result[name][row[0]] = value
+        return result
+
+
+class TmiGroupBalance(BalanceMixin, ModelSQL, ModelView):
+    'Group Balance'
+    __name__ = 'tmi.group.balance'
+    _key = 'group'
+
+    group = fields.Many2One('tmi.group', 'Group', required=True,
+        select=True, readonly=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super(TmiGroupBalance, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('group_period_posted_uniq',
+                Unique(t, t.group, t.period, t.posted),
+                'The balance must be unique per group, period '
+                'and posted state.'),
+            ]
+
+    @classmethod
+    def get_sums(cls, where):
+        '''
+        Return the metric sums of the move lines matching where keyed by
+        (group, period, posted).
+        '''
+        MoveLine = Pool().get('tmi.move.line')
+        line = MoveLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = [line.group, line.period, line.posted]
+        for name in BALANCE_FIELDS:
+            columns.append(Sum(Coalesce(Column(line, name), 0)))
+        cursor.execute(*line.select(*columns,
+                where=where & (line.state != 'draft'),
+                group_by=[line.group, line.period, line.posted]))
+        return cls._row2sums(cursor.fetchall())
+
+    @classmethod
+    def get_balance(cls, ids, names, period_ids):
+        '''
+        Return the balances of names for the group ids from the counters
+        of the periods
+        '''
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        result = dict((n, {}) for n in names)
+        if not period_ids:
+            return result
+        columns = [table.group]
+        for name in names:
+            columns.append(Sum(Coalesce(Column(table, name), 0)))
+        where = Balance.query_get(table, period_ids)
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(*columns,
+                    where=where & reduce_ids(table.group, sub_ids),
+                    group_by=table.group))
+            for row in cursor.fetchall():
+                for i, name in enumerate(names, 1):
+                    # SQLite uses float for SUM
+                    value = row[i]
+                    if not isinstance(value, Decimal):
+                        value = Decimal(str(value))
+                    result[name][row[0]] = value
+        return result
@@ -0,0 +1,289 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Benchmark of the meta group balances.
+
+It generates a synthetic hierarchy with monthly moves in the database of the
+trytond tests and times the tree open, the sort by baptism, the children of
+the church groups and the rendering of the TMI report. The database is selected like for the tests:
+
+    DB_NAME=:memory: python -m trytond.modules.tmi.benchmarks.balance
+
+    TRYTOND_DATABASE_URI=postgresql://localhost/ DB_NAME=bench_tmi \
+        python -m trytond.modules.tmi.benchmarks.balance --years 3
+'''
+import argparse
+import datetime
+import math
+import random
+import time
+from decimal import Decimal
+
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+TYPES = ['conference', 'division', 'union', 'field', 'zone', 'district',
+    'church', 'small_group']
+METRICS = ['baptism', 'small_group', 'tithe', 'offering',
+    'praise_thanksgiving', 'gathering', 'church_planting',
+    'organizing_church']
+TARGETS = ['tmi_%s_target' % m for m in METRICS]
+
+
+class CountingCursor(object):
+    'Cursor counting the executed queries on its connection'
+
+    def __init__(self, cursor, connection):
+        self._cursor = cursor
+        self._connection = connection
+
+    def execute(self, *args, **kwargs):
+        self._connection.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    'Connection proxy returning counting cursors'
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.queries = 0
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(
+            self._connection.cursor(*args, **kwargs), self)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = max(int(math.ceil(percent / 100. * len(values))) - 1, 0)
+    return values[index]
+
+
+def measure(name, func, repeat):
+    transaction = Transaction()
+    timings, queries = [], []
+    for _ in range(repeat):
+        # Start each run with a cold record cache
+        transaction.cache.clear()
+        connection = CountingConnection(transaction.connection)
+        transaction.connection = connection
+        start = time.perf_counter()
+        try:
+            func()
+        finally:
+            transaction.connection = connection._connection
+        timings.append(time.perf_counter() - start)
+        queries.append(connection.queries)
+    print('%-24s p50 %8.1f ms  p95 %8.1f ms  queries %6d' % (name,
+            percentile(timings, 50) * 1000, percentile(timings, 95) * 1000,
+            percentile(queries, 50)))
+
+
+def create_company():
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    Party = pool.get('party.party')
+    Company = pool.get('company.company')
+
+    currency, = Currency.create([{
+                'name': 'Dollar',
+                'code': 'USD',
+                'symbol': '$',
+                'rounding': Decimal('0.01'),
+                'digits': 2,
+                }])
+    party, = Party.create([{'name': 'Conference'}])
+    company, = Company.create([{
+                'party': party.id,
+                'currency': currency.id,
+                'type': 'conference',
+                }])
+    return company
+
+
+def create_configuration(company):
+    'Set a move sequence of the company in the TMI configuration'
+    pool = Pool()
+    Sequence = pool.get('ir.sequence')
+    Configuration = pool.get('tmi.configuration')
+
+    sequence, = Sequence.create([{
+                'name': 'TMI Move',
+                'code': 'tmi.move',
+                'company': company.id,
+                }])
+    config = Configuration(1)
+    config.tmi_move_sequence = sequence
+    config.save()
+
+
+def create_hierarchy(company, fanouts):
+    'Create the meta groups level by level and return the leaf groups'
+    pool = Pool()
+    Meta = pool.get('tmi.meta.group')
+    Group = pool.get('tmi.group')
+
+    parents = Meta.create([{
+                'name': 'Conference',
+                'code': 'C',
+                'type': 'conference',
+                'company': company.id,
+                }])
+    churches = []
+    for type_, fanout in zip(TYPES[1:], fanouts):
+        parents = Meta.create([{
+                    'name': '%s %s' % (parent.name, i),
+                    'code': '%s.%s' % (parent.code, i),
+                    'type': type_,
+                    'parent': parent.id,
+                    'company': company.id,
+                    } for parent in parents for i in range(fanout)])
+        if type_ == 'church':
+            churches = parents
+    Group.create([{'meta': m.id} for m in churches + parents])
+    return churches
+
+
+def create_moves(company, churches, years, post_ratio):
+    pool = Pool()
+    Year = pool.get('tmi.year')
+    Move = pool.get('tmi.move')
+    Group = pool.get('tmi.group')
+
+    groups = {}
+    for group in Group.search([('type', '=', 'small_group')]):
+        groups.setdefault(group.meta.parent.id, []).append(group.id)
+
+    first_year = datetime.date.today().year - years + 1
+    tmi_years = Year.create([{
+                'name': str(y),
+                'start_date': datetime.date(y, 1, 1),
+                'end_date': datetime.date(y, 12, 31),
+                } for y in range(first_year, first_year + years)])
+    Year.create_period(tmi_years)
+
+    rand = random.Random(42)
+    moves = []
+    for tmi_year in tmi_years:
+        vlist = []
+        for period in tmi_year.periods:
+            for church in churches:
+                vlist.append({
+                        'company': company.id,
+                        'group': church.id,
+                        'period': period.id,
+                        'date': period.start_date,
+                        'lines': [('create', [dict(
+                                        [('group', g)]
+                                        + [(m, Decimal(rand.randint(0, 20)))
+                                            for m in METRICS])
+                                    for g in groups.get(church.id, [])])],
+                        })
+        moves += Move.create(vlist)
+    to_post = [m for m in moves if rand.random() < post_ratio]
+    Move.quote(to_post)
+    Move.post(to_post)
+    return tmi_years
+
+
+def run(args):
+    pool = Pool()
+    Meta = pool.get('tmi.meta.group')
+    Group = pool.get('tmi.group')
+    TmiReport = pool.get('tmi.report', type='report')
+
+    company = create_company()
+    with Transaction().set_context(company=company.id):
+        start = time.perf_counter()
+        create_configuration(company)
+        churches = create_hierarchy(company, args.fanout)
+        tmi_years = create_moves(company, churches, args.years, args.posted)
+        print('%d meta groups, %d years generated in %.1f s' % (
+                Meta.search([], count=True), args.years,
+                time.perf_counter() - start))
+
+        year = tmi_years[-1]
+        context = {
+            'company': company.id,
+            'from_date': year.start_date,
+            'to_date': year.end_date,
+            'start_date': year.start_date,
+            'end_date': year.end_date,
+            'posted': True,
+            }
+        with Transaction().set_context(context):
+            def tree_open():
+                parents = Meta.search([('parent', '=', None)])
+                while parents:
+                    records = Meta.read([p.id for p in parents],
+                        ['name', 'code', 'childs'] + METRICS + TARGETS)
+                    parents = Meta.browse(
+                        [c for r in records for c in r['childs']][:1000])
+
+            def sort_by_baptism():
+                churches = Meta.search([('type', '=', 'church')],
+                    order=[('baptism', 'DESC')])
+                Meta.read([c.id for c in churches[:80]], METRICS)
+
+            def group_childs():
+                groups = Group.search([('type', '=', 'church')])
+                Group.get_childs(groups, 'childs')
+
+            def report():
+                TmiReport.execute([], {
+                        'company': company.id,
+                        'start_date': year.start_date,
+                        'end_date': year.end_date,
+                        'type': 'field',
+                        'child_type': 'zone',
+                        'posted': True,
+                        })
+
+            measure('tree open', tree_open, args.repeat)
+            measure('sort by baptism', sort_by_baptism, args.repeat)
+            measure('group childs', group_childs, args.repeat)
+            measure('tmi.report', report, args.repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--fanout', type=int, nargs=7,
+        default=[1, 1, 2, 3, 3, 4, 5],
+        metavar=('DIVISION', 'UNION', 'FIELD', 'ZONE', 'DISTRICT', 'CHURCH',
+            'SMALL_GROUP'),
+        help='children per parent for each level below the conference')
+    parser.add_argument('--years', type=int, default=2,
+        help='number of years of monthly moves')
+    parser.add_argument('--posted', type=float, default=0.8,
+        help='ratio of posted moves')
+    parser.add_argument('--repeat', type=int, default=20,
+        help='number of runs of each measure')
+    args = parser.parse_args()
+
+    activate_module('tmi')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        try:
+            run(args)
+        finally:
+            Transaction().rollback()
+
+
+if __name__ == '__main__':
+    main()
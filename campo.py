@@ -37,3 +37,10 @@ class Campo(ModelView, ModelSQL):
     @classmethod
     def delete(cls, records):
         cls.raise_user_error('delete_records')
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        super(Campo, cls).write(*args)
+        Iglesia._ancestors_cache.clear()
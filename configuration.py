@@ -3,10 +3,12 @@
 from decimal import Decimal
 
 from trytond import backend
+from trytond.cache import Cache
 from trytond.model import (ModelView, ModelSQL, ModelSingleton, ValueMixin,
     fields)
 from trytond.pool import Pool
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
 from trytond.tools.multivalue import migrate_property
 from trytond.modules.company.model import (
     CompanyMultiValueMixin, CompanyValueMixin)
@@ -15,6 +17,11 @@ __all__ = ['Configuration',
     'ConfigurationSequence',
     'ConfigurationTarget']
 
+TARGET_FIELDS = ['tmi_baptism_target', 'tmi_small_group_target',
+    'tmi_tithe_target', 'tmi_offering_target',
+    'tmi_praise_thanksgiving_target', 'tmi_gathering_target',
+    'tmi_church_planting_target', 'tmi_organizing_church_target']
+
 
 def default_func(field_name):
     @classmethod
@@ -60,6 +67,8 @@ class Configuration(
         'TMI Group Organizing Church Target', required=True, digits=(16,0),
         ))
 
+    _targets_cache = Cache('tmi.configuration.targets')
+
     @classmethod
     def multivalue_model(cls, field):
         pool = Pool()
@@ -105,6 +114,21 @@ class Configuration(
 
     default_tmi_move_sequence = default_func('tmi_move_sequence')
 
+    @classmethod
+    def get_targets(cls, company=None):
+        '''
+        Return a dictionary with the targets of the company
+        '''
+        if company is None:
+            company = Transaction().context.get('company')
+        targets = cls._targets_cache.get(company)
+        if targets is None:
+            config = cls(1)
+            targets = dict((f, config.get_multivalue(f, company=company))
+                for f in TARGET_FIELDS)
+            cls._targets_cache.set(company, targets)
+        return targets.copy()
+
 
 class ConfigurationSequence(ModelSQL, CompanyValueMixin):
     "TMI Configuration Sequence"
@@ -187,4 +211,20 @@ class ConfigurationTarget(ModelSQL, CompanyValueMixin):
 
     @classmethod
     def default_tmi_organizing_church_target(cls):
-        return Decimal('1')
\ No newline at end of file
+        return Decimal('1')
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(ConfigurationTarget, cls).create(vlist)
+        Pool().get('tmi.configuration')._targets_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(ConfigurationTarget, cls).write(*args)
+        Pool().get('tmi.configuration')._targets_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super(ConfigurationTarget, cls).delete(records)
+        Pool().get('tmi.configuration')._targets_cache.clear()
@@ -36,4 +36,11 @@ class Distrito(ModelView, ModelSQL):
 
     @classmethod
     def delete(cls, records):
-        cls.raise_user_error('delete_records')
\ No newline at end of file
+        cls.raise_user_error('delete_records')
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        super(Distrito, cls).write(*args)
+        Iglesia._ancestors_cache.clear()
@@ -0,0 +1,299 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import uuid
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sql import Column, Literal
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
+
+from trytond.cache import Cache, LRUDict
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+from .balance import BALANCE_FIELDS
+
+__all__ = ['HierarchyEngine']
+
+
+class HierarchyEngine(object):
+    '''
+    In-memory arrays of the meta group tree of the context company in
+    nested set order and of their metrics for the context, used when numpy
+    is installed.
+    The metrics are kept with the tree under the balance revision of their
+    periods, so a change only reloads the periods it touches.
+    '''
+    # The tree only depends on the company
+    _tree_cache = Cache('tmi.meta.group.engine.tree', context=False)
+    _metrics_size = 1024
+
+    @staticmethod
+    def available():
+        return numpy is not None
+
+    @classmethod
+    def clear(cls):
+        cls._tree_cache.clear()
+
+    @classmethod
+    def invalidate(cls, period_ids):
+        '''
+        Give a new balance revision to the periods whose metrics changed.
+        The revision is random so the one of a rolled back transaction is
+        never reused.
+        '''
+        Period = Pool().get('tmi.period')
+        period = Period.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(list(period_ids)):
+            cursor.execute(*period.update(
+                    columns=[period.balance_revision],
+                    values=[uuid.uuid4().hex],
+                    where=reduce_ids(period.id, sub_ids)))
+
+    @classmethod
+    def _get_revisions(cls, period_ids):
+        'Return the balance revision of each period id'
+        Period = Pool().get('tmi.period')
+        period = Period.__table__()
+        cursor = Transaction().connection.cursor()
+        revisions = {}
+        for sub_ids in grouped_slice(period_ids):
+            cursor.execute(*period.select(period.id, period.balance_revision,
+                    where=reduce_ids(period.id, sub_ids)))
+            revisions.update(cursor.fetchall())
+        return revisions
+
+    @classmethod
+    def get_tree(cls):
+        '''
+        Return the arrays of the meta groups of the context company ordered
+        by left with for each one the index after its last descendant as end
+        '''
+        company_id = Transaction().context.get('company')
+        tree = cls._tree_cache.get(company_id)
+        if tree is not None:
+            return tree
+        Meta = Pool().get('tmi.meta.group')
+        table = Meta.__table__()
+        cursor = Transaction().connection.cursor()
+        where = Literal(True)
+        if company_id:
+            where &= table.company == company_id
+        cursor.execute(*table.select(table.id, table.parent, table.left,
+                table.right, table.type, where=where,
+                order_by=table.left.asc))
+        rows = cursor.fetchall()
+
+        index = dict((r[0], i) for i, r in enumerate(rows))
+        left = numpy.array([r[2] for r in rows], dtype=numpy.int64)
+        right = numpy.array([r[3] for r in rows], dtype=numpy.int64)
+        types = numpy.array([r[4] or '' for r in rows], dtype=object)
+        tree = {
+            'company': company_id,
+            'ids': numpy.array([r[0] for r in rows], dtype=numpy.int64),
+            'index': index,
+            'parent': numpy.array([index.get(r[1], -1) for r in rows],
+                dtype=numpy.int64),
+            'types': types,
+            'end': numpy.searchsorted(left, right, side='right'),
+            # The metrics keyed by the revisions of their periods
+            'metrics': LRUDict(cls._metrics_size),
+            }
+        tree['child_values'] = cls._subtree_sums(tree,
+            (types == 'small_group').astype(numpy.float64))
+        cls._tree_cache.set(company_id, tree)
+        return tree
+
+    @classmethod
+    def _subtree_sums(cls, tree, values):
+        'Sum the values of each subtree with a cumulative sum'
+        cumulated = numpy.zeros((len(values) + 1,) + values.shape[1:])
+        numpy.cumsum(values, axis=0, out=cumulated[1:])
+        return cumulated[tree['end']] - cumulated[:-1]
+
+    @classmethod
+    def _meta_where(cls, tree, column):
+        'Return the SQL clause limiting column to the meta groups of tree'
+        Meta = Pool().get('tmi.meta.group')
+        meta = Meta.__table__()
+        if not tree['company']:
+            return Literal(True)
+        return column.in_(meta.select(meta.id,
+                where=meta.company == tree['company']))
+
+    @classmethod
+    def get_metrics(cls):
+        '''
+        Return the subtree sums of the metrics for the context as a matrix
+        of the meta groups by BALANCE_FIELDS and the number of small groups
+        of each subtree
+        '''
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        tree = cls.get_tree()
+
+        period_ids = Balance.get_context_periods()
+        if period_ids is not None:
+            sums = cls._get_rollup_sums(tree, period_ids)
+        else:
+            sums = cls._get_line_sums(tree)
+        return {
+            'sums': sums,
+            'child_values': tree['child_values'],
+            }
+
+    @classmethod
+    def _get_rollup_sums(cls, tree, period_ids):
+        '''
+        Return the subtree sums read from the rollup for the open periods
+        and from the snapshots for the closed ones.
+        Only the periods without metrics for their revision are read.
+        '''
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        Snapshot = pool.get('tmi.meta.group.snapshot')
+        cursor = Transaction().connection.cursor()
+        index = tree['index']
+        cache = tree['metrics']
+        posted = bool(Transaction().context.get('posted'))
+
+        closed_ids = set(Snapshot.get_closed_periods(period_ids))
+        revisions = cls._get_revisions(period_ids)
+        sums = numpy.zeros((len(tree['ids']), len(BALANCE_FIELDS)))
+        to_load = {}
+        for period_id in period_ids:
+            key = ('period', period_id, posted, period_id in closed_ids,
+                revisions.get(period_id))
+            values = cache.get(key)
+            if values is None:
+                to_load[period_id] = key
+            else:
+                sums += values
+        for Model, closed in ((Balance, False), (Snapshot, True)):
+            ids = [p for p in to_load if (p in closed_ids) == closed]
+            if not ids:
+                continue
+            values = dict((p, numpy.zeros(sums.shape)) for p in ids)
+            table = Model.__table__()
+            cursor.execute(*table.select(table.period, table.meta,
+                    *[Sum(Coalesce(Column(table, n), 0))
+                        for n in BALANCE_FIELDS],
+                    where=Balance.query_get(table, ids)
+                    & cls._meta_where(tree, table.meta),
+                    group_by=[table.period, table.meta]))
+            for row in cursor.fetchall():
+                if row[1] in index:
+                    values[row[0]][index[row[1]]] += [
+                        float(v) for v in row[2:]]
+            for period_id, period_values in values.items():
+                cache[to_load[period_id]] = period_values
+                sums += period_values
+        return sums
+
+    @classmethod
+    def _get_line_sums(cls, tree):
+        '''
+        Return the subtree sums of the lines for the context, kept for the
+        revisions of the periods of the context
+        '''
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        Period = pool.get('tmi.period')
+        context = Transaction().context
+
+        periods = Balance._get_context_periods()
+        if periods is None:
+            date = context['date']
+            periods = Period.search([
+                    ('year.start_date', '<=', date),
+                    ('year.end_date', '>=', date),
+                    ])
+        period_ids = sorted(p.id for p in periods)
+        revisions = cls._get_revisions(period_ids)
+        key = ('lines', bool(context.get('posted')), context.get('date'),
+            context.get('from_date'), context.get('to_date'),
+            tuple((p, revisions.get(p)) for p in period_ids))
+        sums = tree['metrics'].get(key)
+        if sums is None:
+            sums = cls._subtree_sums(tree, cls._get_line_values(tree))
+            tree['metrics'][key] = sums
+        return sums
+
+    @classmethod
+    def _get_line_values(cls, tree):
+        'Return the sums of the lines of each meta group for the context'
+        pool = Pool()
+        Group = pool.get('tmi.group')
+        MoveLine = pool.get('tmi.move.line')
+        group = Group.__table__()
+        line = MoveLine.__table__()
+        cursor = Transaction().connection.cursor()
+        index = tree['index']
+
+        line_query, _ = MoveLine.query_get(line)
+        cursor.execute(*line.join(group, condition=line.group == group.id
+                ).select(group.meta,
+                *[Sum(Coalesce(Column(line, n), 0)) for n in BALANCE_FIELDS],
+                where=line_query & cls._meta_where(tree, group.meta),
+                group_by=group.meta))
+        values = numpy.zeros((len(tree['ids']), len(BALANCE_FIELDS)))
+        for row in cursor.fetchall():
+            if row[0] in index:
+                values[index[row[0]]] = [float(v) for v in row[1:]]
+        return values
+
+    @classmethod
+    def _mask(cls, type_=None, parent=None):
+        tree = cls.get_tree()
+        mask = numpy.ones(len(tree['ids']), dtype=bool)
+        if type_:
+            mask &= tree['types'] == type_
+        if parent is not None:
+            start = tree['index'][parent]
+            positions = numpy.arange(len(mask))
+            mask &= (positions > start) & (positions < tree['end'][start])
+        return mask
+
+    @classmethod
+    def top(cls, metric, limit=10, type_=None, parent=None):
+        '''
+        Return the (id, value) of the limit meta groups with the highest
+        metric
+        '''
+        tree = cls.get_tree()
+        values = cls.get_metrics()['sums'][:, BALANCE_FIELDS.index(metric)]
+        positions = numpy.flatnonzero(cls._mask(type_, parent))
+        order = numpy.argsort(-values[positions], kind='stable')[:limit]
+        positions = positions[order]
+        return list(zip(tree['ids'][positions].tolist(),
+                values[positions].tolist()))
+
+    @classmethod
+    def percentile(cls, metric, percent, type_=None, parent=None):
+        'Return the percentile of the metric among the meta groups'
+        values = cls.get_metrics()['sums'][:, BALANCE_FIELDS.index(metric)]
+        values = values[cls._mask(type_, parent)]
+        if not len(values):
+            return None
+        return float(numpy.percentile(values, percent))
+
+    @classmethod
+    def attainment(cls, metric, target, type_=None, parent=None):
+        '''
+        Return for each meta group the ratio of the metric to the target
+        for each of its small groups
+        '''
+        tree = cls.get_tree()
+        metrics = cls.get_metrics()
+        mask = cls._mask(type_, parent)
+        values = metrics['sums'][mask, BALANCE_FIELDS.index(metric)]
+        targets = metrics['child_values'][mask] * float(target or 0)
+        ratios = numpy.divide(values, targets,
+            out=numpy.zeros_like(values), where=targets != 0)
+        return dict(zip(tree['ids'][mask].tolist(), ratios.tolist()))
@@ -47,6 +47,21 @@ class Gp(ModelView, ModelSQL):
     def delete(cls, records):
         cls.raise_user_error('delete_records')
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        gps = super(Gp, cls).create(vlist)
+        Iglesia._ancestors_cache.clear()
+        return gps
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        super(Gp, cls).write(*args)
+        Iglesia._ancestors_cache.clear()
+
     @classmethod
     def default_active(cls):
         return True
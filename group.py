@@ -2,36 +2,63 @@
 # this repository contains the full copyright notices and license terms.
 from decimal import Decimal
 from datetime import datetime
+import csv
 import datetime
+import io
 import operator
+import tempfile
+from bisect import bisect_left, bisect_right
 from functools import wraps
 
 from dateutil.relativedelta import relativedelta
-from sql import Column, Null, Window, Literal
+from sql import Column, Null, Window, Literal, Union
 from sql.functions import CharLength
 
-from sql.aggregate import Sum, Max
+from sql.aggregate import Sum, Max, Count
 from sql.conditionals import Coalesce, Case
 
 from trytond.model import (
     ModelView, ModelSQL, DeactivableMixin, fields, Unique, sequence_ordered,
     tree)
 from trytond.wizard import Wizard, StateView, StateAction, StateTransition, \
-    Button
+    StateReport, Button
 from trytond.report import Report
 from trytond.tools import reduce_ids, grouped_slice
 from trytond.pyson import Eval, If, PYSONEncoder, Bool
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.rpc import RPC
 from trytond import backend
 from .common import PeriodMixin, ActivePeriodMixin
+from .balance import BALANCE_FIELDS
+from .configuration import TARGET_FIELDS
+from .engine import HierarchyEngine
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 __all__ = [
     'TmiMetaGroup',
     'TmiGroup',
     'TmiGroupStatisticalContext',
+    'ExportBalanceSheetStart',
+    'ExportBalanceSheet',
+    'BalanceSheetReport',
     ]
 
+EXPORT_FIELDS = ['id', 'code', 'name', 'type', 'parent'] + BALANCE_FIELDS \
+    + TARGET_FIELDS
+EXPORT_BATCH = 1000
+SERIES_MONTHS = {
+    'month': 1,
+    'quarter': 3,
+    'year': 12,
+    }
+
+
 def diff_month(d1, d2):
     return (d1.year - d2.year) * 12 + d1.month - d2.month
 
@@ -114,7 +141,7 @@ class TmiMetaGroup(
     company = fields.Many2One('company.company', 'Company', required=True,
             ondelete="RESTRICT")
     child_value = fields.Function(fields.Numeric('Child Value'),
-        'get_child_value')
+        'get_child_value', searcher='search_child_value')
 
     tmi_baptism_target = fields.Function(fields.Numeric('Baptism Target',
         digits=(16,0 )), 'get_target')
@@ -202,6 +229,19 @@ class TmiMetaGroup(
         #cls._order.insert(0, ('baptism', 'ASC'))
         cls._order.insert(0, ('name', 'ASC'))
         cls._order.insert(0, ('code', 'ASC'))
+        cls.__rpc__.update({
+                'get_series': RPC(),
+                'get_top': RPC(),
+                'get_percentile': RPC(),
+                'get_attainment': RPC(),
+                })
+        cls._error_messages.update({
+                'export_unknown_format': ('Unknown export format "%s".'),
+                'export_missing_pyarrow': ('The Parquet export requires '
+                    'the pyarrow library.'),
+                'engine_missing_numpy': ('The rankings require the numpy '
+                    'library.'),
+                })
 
     @staticmethod
     def default_left():
@@ -345,18 +385,6 @@ class TmiMetaGroup(
     def get_currency_digits(self, name):
         return self.company.currency.digits
 
-    def get_child_value(self, name):
-        if self.childs is not None and self.type !='small_group':
-            return sum(x.child_value for x in self.childs)
-        elif self.childs is None and self.type =='small_group':
-            return 1
-        else:
-            children_sum = 1
-            for child in self.childs:
-                children_sum = sum(x.child_value for x in self.childs if x.type=='small_group')
-            return children_sum
-        return 0
-
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
@@ -369,11 +397,43 @@ class TmiMetaGroup(
     def default_type():
         return 'small_group'
 
+    @classmethod
+    def create(cls, vlist):
+        metas = super(TmiMetaGroup, cls).create(vlist)
+        HierarchyEngine.clear()
+        return metas
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        actions = iter(args)
+        moved, reshaped = [], False
+        for metas, values in zip(actions, actions):
+            if 'parent' in values:
+                moved.extend(metas)
+            reshaped |= bool({'parent', 'type'} & set(values))
+        # Only the rows of the old and new ancestors of the moved subtrees
+        # change in the rollup
+        before = Balance.get_meta_sums(moved) if moved else {}
+        super(TmiMetaGroup, cls).write(*args)
+        if reshaped:
+            HierarchyEngine.clear()
+        if moved:
+            # The snapshots of the closed periods keep the former tree
+            Balance.update_sums(before, Balance.get_meta_sums(moved),
+                check_periods=False)
+
+    @classmethod
+    def delete(cls, metas):
+        super(TmiMetaGroup, cls).delete(metas)
+        HierarchyEngine.clear()
+
     @classmethod
     def get_balance(cls, metas, names):
         pool = Pool()
-        MoveLine = pool.get('tmi.move.line')
-        Group = pool.get('tmi.group')
+        Balance = pool.get('tmi.meta.group.balance')
+        Snapshot = pool.get('tmi.meta.group.snapshot')
         cursor = Transaction().connection.cursor()
 
         result = {}
@@ -385,48 +445,139 @@ class TmiMetaGroup(
                 raise ValueError('Unknown name: %s' % name)
             result[name] = dict((i, Decimal(0)) for i in ids)
 
+        period_ids = Balance.get_context_periods()
+        if period_ids is not None:
+            # The context is aligned on periods so the rollup can be used
+            # and closed periods are served from their snapshots
+            closed_ids = Snapshot.get_closed_periods(period_ids)
+            for name, values in Snapshot.get_sums(
+                    ids, names, closed_ids).items():
+                result[name].update(values)
+            open_ids = [p for p in period_ids if p not in closed_ids]
+            balance = Balance.__table__()
+            balance_query = Balance.query_get(balance, open_ids)
+            columns = [balance.meta]
+            for name in names:
+                columns.append(Sum(Coalesce(Column(balance, name), 0)))
+            for sub_ids in grouped_slice(ids if open_ids else []):
+                cursor.execute(*balance.select(*columns,
+                        where=balance_query
+                        & reduce_ids(balance.meta, sub_ids),
+                        group_by=balance.meta))
+                for row in cursor.fetchall():
+                    meta_id = row[0]
+                    for i, name in enumerate(names, 1):
+                        # SQLite uses float for SUM
+                        value = row[i]
+                        if not isinstance(value, Decimal):
+                            value = Decimal(str(value))
+                        result[name][meta_id] += value
+        else:
+            for name, values in cls._get_tree_balance(ids, names).items():
+                result[name].update(values)
+        for meta in metas:
+            for name in names:
+                exp = Decimal(str(10.0 ** -meta.currency_digits))
+                result[name][meta.id] = (
+                    result[name][meta.id].quantize(exp))
+        return result
 
-        table_a = cls.__table__()
-        table_c = cls.__table__()
+    @classmethod
+    def _get_tree_balance(cls, ids, names):
+        '''
+        Return the balances of the meta groups computed with a single scan
+        of the move lines: the lines are summed per meta group and the sums
+        are rolled up through the nested set.
+        '''
+        pool = Pool()
+        MoveLine = pool.get('tmi.move.line')
+        Group = pool.get('tmi.group')
+        Snapshot = pool.get('tmi.meta.group.snapshot')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
         group = Group.__table__()
         line = MoveLine.__table__()
-        line_query, fiscalyear_ids = MoveLine.query_get(line)
 
-        columns = [table_a.id]
+        # Closed periods are served from their snapshots
+        closed_ids = Snapshot.get_closed_periods()
+        result = Snapshot.get_sums(ids, names, closed_ids)
+        bounds = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.select(table.id, table.left, table.right,
+                    where=reduce_ids(table.id, sub_ids)))
+            bounds.extend(cursor.fetchall())
+        if not bounds:
+            return result
+
+        line_query, fiscalyear_ids = MoveLine.query_get(line,
+            exclude_periods=closed_ids)
+        min_left = min(b[1] for b in bounds)
+        max_right = max(b[2] for b in bounds)
+        columns = [table.left]
         for name in names:
             columns.append(Sum(Coalesce(Column(line, name), 0)))
-        for sub_ids in grouped_slice(ids):
-            cursor.execute(*table_a.join(table_c,
-                    condition=(table_c.left >= table_a.left)
-                    & (table_c.right <= table_a.right)
-                    ).join(group, condition=group.meta == table_c.id
-                    ).join(line, condition=line.group == group.id
-                    ).select(*columns,
-                    where=line_query & reduce_ids(table_a.id, sub_ids),
-                    group_by=table_a.id))
-            for row in cursor.fetchall():
-                meta_id = row[0]
-                for i, name in enumerate(names, 1):
-                    # SQLite uses float for SUM
-                    if not isinstance(row[i], Decimal):
-                        result[name][meta_id] = Decimal(str(row[i]))
-                    else:
-                        result[name][meta_id] = row[i]
-        for meta in metas:
-            for name in names:
-                exp = Decimal(str(10.0 ** -meta.currency_digits))
-                result[name][meta.id] = (
-                    result[name][meta.id].quantize(exp))
+        cursor.execute(*line.join(group, condition=line.group == group.id
+                ).join(table, condition=group.meta == table.id
+                ).select(*columns,
+                where=line_query
+                & (table.left >= min_left) & (table.right <= max_right),
+                group_by=table.left,
+                order_by=table.left))
+
+        # Cumulative sums in nested set order so the balance of a subtree is
+        # the difference between the sums at its right and left bounds
+        lefts = []
+        cumulated = [[Decimal(0)] * len(names)]
+        for row in cursor.fetchall():
+            lefts.append(row[0])
+            sums = []
+            for previous, amount in zip(cumulated[-1], row[1:]):
+                # SQLite uses float for SUM
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                sums.append(previous + amount)
+            cumulated.append(sums)
+
+        for meta_id, left, right in bounds:
+            start = bisect_left(lefts, left)
+            end = bisect_right(lefts, right)
+            for i, name in enumerate(names):
+                result[name][meta_id] = (
+                    result[name].get(meta_id, Decimal(0))
+                    + cumulated[end][i] - cumulated[start][i])
         return result
 
     @classmethod
-    def search_balance(cls, name, clause):
+    def _balance_query(cls, name):
+        '''
+        Return a query computing the balance of name as balance_amount
+        for each meta group id
+        '''
         pool = Pool()
         MoveLine = pool.get('tmi.move.line')
         Group = pool.get('tmi.group')
+        Balance = pool.get('tmi.meta.group.balance')
+        Snapshot = pool.get('tmi.meta.group.snapshot')
+
+        period_ids = Balance.get_context_periods()
+        if period_ids is not None:
+            closed_ids = Snapshot.get_closed_periods(period_ids)
+            open_ids = [p for p in period_ids if p not in closed_ids]
+            balance = Balance.__table__()
+            snapshot = Snapshot.__table__()
+            rows = Union(
+                balance.select(balance.meta,
+                    Column(balance, name).as_('amount'),
+                    where=Balance.query_get(balance, open_ids)),
+                snapshot.select(snapshot.meta,
+                    Column(snapshot, name).as_('amount'),
+                    where=Balance.query_get(snapshot, closed_ids)),
+                all_=True)
+            amount = Sum(Coalesce(rows.amount, 0))
+            return rows.select(rows.meta.as_('id'),
+                amount.as_('balance_amount'),
+                group_by=rows.meta)
 
-        _, operator, value = clause
-        Operator = fields.SQL_OPERATORS[operator]
         table_a = cls.__table__()
         table_c = cls.__table__()
         group = Group.__table__()
@@ -434,42 +585,32 @@ class TmiMetaGroup(
         line_query, fiscalyear_ids = MoveLine.query_get(line)
 
         amount = Sum(Coalesce(Column(line, name), 0))
-        query = table_a.join(table_c,
+        return table_a.join(table_c,
             condition=(table_c.left >= table_a.left)
             & (table_c.right <= table_a.right)
             ).join(group, condition=group.meta == table_c.id
             ).join(line, condition=line.group == group.id
-            ).select(table_a.id,
+            ).select(table_a.id, amount.as_('balance_amount'),
                 where=line_query,
-                group_by=table_a.id,
-                having=Operator(amount, value))
+                group_by=table_a.id)
+
+    @classmethod
+    def search_balance(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = cls._balance_query(name)
+        query = query.select(query.id,
+            where=Operator(query.balance_amount, value))
         return [('id', 'in', query)]
 
     def _order_balance_field(name):
         def order_field(tables):
             pool = Pool()
-            MoveLine = pool.get('tmi.move.line')
-            Group = pool.get('tmi.group')
             Meta = pool.get('tmi.meta.group')
             balance_tables = tables.get('balance')
             if balance_tables is None:
                 table, _ = tables[None]
-
-                table_a = Meta.__table__()
-                table_c = Meta.__table__()
-                group = Group.__table__()
-                line = MoveLine.__table__()
-                line_query, fiscalyear_ids = MoveLine.query_get(line)
-
-                amount = Sum(Coalesce(Column(line, name), 0))
-                query = table_a.join(table_c,
-                    condition=(table_c.left >= table_a.left)
-                    & (table_c.right <= table_a.right)
-                    ).join(group, condition=group.meta == table_c.id
-                    ).join(line, condition=line.group == group.id
-                    ).select(table_a.id, amount.as_('balance_amount'),
-                        where=line_query,
-                        group_by=table_a.id)
+                query = Meta._balance_query(name)
                 balance_tables = {
                     None: (query, query.id == table.id),
                     }
@@ -484,8 +625,7 @@ class TmiMetaGroup(
     def get_baptism_target(self, name=None):
         pool = Pool()
         Configuration = pool.get('tmi.configuration')
-        config = Configuration(1)
-        target = config.get_multivalue('tmi_baptism_target')
+        target = Configuration.get_targets()['tmi_baptism_target']
         context = Transaction().context
         start_date = context.get('start_date')
         end_date = context.get('end_date')
@@ -498,72 +638,342 @@ class TmiMetaGroup(
             total = target * value
         return total
 
-    def get_target(self, name):
+    @classmethod
+    def _child_value_query(cls, ids=None):
+        '''
+        Return a query counting the small groups under each meta group as
+        child_value
+        '''
+        table_a = cls.__table__()
+        table_c = cls.__table__()
+        where = Literal(True)
+        if ids is not None:
+            where &= reduce_ids(table_a.id, ids)
+        return table_a.join(table_c, 'LEFT',
+            condition=(table_c.left >= table_a.left)
+            & (table_c.right <= table_a.right)
+            & (table_c.type == 'small_group')
+            ).select(table_a.id,
+                Count(table_c.id).as_('child_value'),
+                where=where,
+                group_by=table_a.id)
+
+    @classmethod
+    def _get_child_values(cls, ids):
+        '''
+        Return the number of small groups under each meta group id
+        '''
+        cursor = Transaction().connection.cursor()
+
+        result = dict((i, 0) for i in ids)
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*cls._child_value_query(sub_ids))
+            result.update(cursor.fetchall())
+        return result
+
+    @classmethod
+    def get_child_value(cls, metas, name):
+        return dict((i, Decimal(v))
+            for i, v in cls._get_child_values([m.id for m in metas]).items())
+
+    @classmethod
+    def search_child_value(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = cls._child_value_query()
+        return [('id', 'in', query.select(query.id,
+                    where=Operator(query.child_value, value)))]
+
+    @staticmethod
+    def order_child_value(tables):
+        pool = Pool()
+        Meta = pool.get('tmi.meta.group')
+        child_tables = tables.get('child_value')
+        if child_tables is None:
+            table, _ = tables[None]
+            query = Meta._child_value_query()
+            child_tables = {
+                None: (query, query.id == table.id),
+                }
+            tables['child_value'] = child_tables
+        query, _ = child_tables[None]
+        return [query.child_value]
+
+    @classmethod
+    def get_target(cls, metas, names):
         pool = Pool()
         Configuration = pool.get('tmi.configuration')
-        if name not in {'tmi_baptism_target','tmi_tithe_target','tmi_offering_target','tmi_church_planting_target',
-                'tmi_gathering_target','tmi_small_group_target','tmi_organizing_church_target',
-                'tmi_praise_thanksgiving_target'}:
-            raise ValueError('Unknown name: %s' % name)
-        config = Configuration(1)
-        field = str(name)
-        target = config.get_multivalue(field)
+        for name in names:
+            if name not in {'tmi_baptism_target','tmi_tithe_target','tmi_offering_target','tmi_church_planting_target',
+                    'tmi_gathering_target','tmi_small_group_target','tmi_organizing_church_target',
+                    'tmi_praise_thanksgiving_target'}:
+                raise ValueError('Unknown name: %s' % name)
+        targets = Configuration.get_targets()
         context = Transaction().context
         start_date = context.get('start_date')
         end_date = context.get('end_date')
-        value = self.child_value
+        months = 1
         if start_date and end_date:
             months = diff_month(end_date, start_date)
-            value = value * months
-        total = 0
-        if target and value:
-            total = target * value
-        return total
+        child_values = cls._get_child_values([m.id for m in metas])
 
-    def get_difference(self, name):
-        pool = Pool()
-
-        if name not in {'tmi_baptism_difference','tmi_tithe_difference','tmi_offering_difference','tmi_church_planting_difference',
-                'tmi_gathering_difference','tmi_small_group_difference','tmi_organizing_church_difference',
-                'tmi_praise_thanksgiving_difference'}:
-            raise ValueError('Unknown name: %s' % name)
+        result = {}
+        for name in names:
+            target = targets[name]
+            result[name] = {}
+            for meta in metas:
+                value = child_values[meta.id] * months
+                total = 0
+                if target and value:
+                    total = target * value
+                result[name][meta.id] = total
+        return result
 
-        field = str(name)
-        target_field = field.replace('difference','target')
-        base_field = field.replace('tmi_','')
-        base_field = base_field.replace('_difference','')
+    @classmethod
+    def _get_target_balance(cls, metas, names, suffix):
+        '''
+        Return the targets and balances of the metrics of the
+        difference or percentage names
+        '''
+        target_names = {}
+        base_names = {}
+        for name in names:
+            target_names[name] = name.replace(suffix, 'target')
+            base_names[name] = name.replace('tmi_', '').replace(
+                '_' + suffix, '')
+        targets = cls.get_target(metas, list(set(target_names.values())))
+        balances = cls.get_balance(metas, list(set(base_names.values())))
+        return dict((n, (targets[target_names[n]], balances[base_names[n]]))
+            for n in names)
 
+    @classmethod
+    def get_difference(cls, metas, names):
+        for name in names:
+            if name not in {'tmi_baptism_difference','tmi_tithe_difference','tmi_offering_difference','tmi_church_planting_difference',
+                    'tmi_gathering_difference','tmi_small_group_difference','tmi_organizing_church_difference',
+                    'tmi_praise_thanksgiving_difference'}:
+                raise ValueError('Unknown name: %s' % name)
 
-        target_field_value = getattr(self, target_field,None)
-        base_field_value = getattr(self, base_field,None)
+        result = {}
+        for name, (targets, balances) in cls._get_target_balance(
+                metas, names, 'difference').items():
+            result[name] = dict((m.id, targets[m.id] - balances[m.id])
+                for m in metas)
+        return result
 
-        difference = target_field_value - base_field_value
+    @classmethod
+    def get_percentage(cls, metas, names):
+        for name in names:
+            if name not in {'tmi_baptism_percentage','tmi_tithe_percentage','tmi_offering_percentage','tmi_church_planting_percentage',
+                    'tmi_gathering_percentage','tmi_small_group_percentage','tmi_organizing_church_percentage',
+                    'tmi_praise_thanksgiving_percentage'}:
+                raise ValueError('Unknown name: %s' % name)
 
-        return difference
+        result = {}
+        for name, (targets, balances) in cls._get_target_balance(
+                metas, names, 'percentage').items():
+            result[name] = {}
+            for meta in metas:
+                percentage = 0
+                if targets[meta.id]:
+                    percentage = round(balances[meta.id] / targets[meta.id], 2)
+                result[name][meta.id] = percentage
+        return result
 
-    def get_percentage(self, name):
+    @classmethod
+    def get_series(cls, ids, metrics, start, end, granularity='month'):
+        '''
+        Return the series of the metrics of the meta group ids of the
+        context company for the periods overlapping start and end, grouped by
+        month, quarter or year, as:
+            {'dates': [first day of each bucket],
+                'ids': ids,
+                'metrics': {metric: [[value of each id] for each bucket]}}
+        '''
         pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        Period = pool.get('tmi.period')
+        balance = Balance.__table__()
+        period = Period.__table__()
+        meta = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        company_id = Transaction().context.get('company')
+
+        for metric in metrics:
+            if metric not in BALANCE_FIELDS:
+                raise ValueError('Unknown metric: %s' % metric)
+        if granularity not in SERIES_MONTHS:
+            raise ValueError('Unknown granularity: %s' % granularity)
+        step = SERIES_MONTHS[granularity]
+
+        def bucket(date):
+            return datetime.date(date.year,
+                (date.month - 1) // step * step + 1, 1)
+        dates = []
+        date = bucket(start)
+        while date <= end:
+            dates.append(date)
+            date += relativedelta(months=step)
+        date2index = dict((d, i) for i, d in enumerate(dates))
+        id2index = dict((i, n) for n, i in enumerate(ids))
+        values = dict((m, [[Decimal(0)] * len(ids) for _ in dates])
+            for m in metrics)
+
+        period_ids = [p.id for p in Period.search([
+                    ('end_date', '>=', start),
+                    ('start_date', '<=', end),
+                    ])]
+        if ids and period_ids:
+            columns = [balance.meta, period.start_date]
+            for metric in metrics:
+                columns.append(Sum(Coalesce(Column(balance, metric), 0)))
+            where = Balance.query_get(balance, period_ids)
+            if company_id:
+                where &= meta.company == company_id
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*balance.join(period,
+                        condition=balance.period == period.id
+                        ).join(meta, condition=balance.meta == meta.id
+                        ).select(*columns,
+                        where=where & reduce_ids(balance.meta, sub_ids),
+                        group_by=[balance.meta, period.start_date]))
+                for row in cursor.fetchall():
+                    meta_id, start_date = row[:2]
+                    if isinstance(start_date, str):
+                        start_date = datetime.date(
+                            *map(int, start_date.split('-')))
+                    # A period starting before start goes to the first bucket
+                    i = date2index[bucket(max(start_date, start))]
+                    j = id2index[meta_id]
+                    for metric, value in zip(metrics, row[2:]):
+                        # SQLite uses float for SUM
+                        if not isinstance(value, Decimal):
+                            value = Decimal(str(value))
+                        values[metric][i][j] += value
+        return {
+            'dates': dates,
+            'ids': list(ids),
+            'metrics': values,
+            }
 
-        if name not in {'tmi_baptism_percentage','tmi_tithe_percentage','tmi_offering_percentage','tmi_church_planting_percentage',
-                'tmi_gathering_percentage','tmi_small_group_percentage','tmi_organizing_church_percentage',
-                'tmi_praise_thanksgiving_percentage'}:
-            raise ValueError('Unknown name: %s' % name)
+    @classmethod
+    def _check_engine(cls, metric):
+        if not HierarchyEngine.available():
+            cls.raise_user_error('engine_missing_numpy')
+        if metric not in BALANCE_FIELDS:
+            raise ValueError('Unknown metric: %s' % metric)
 
-        field = str(name)
-        target_field = field.replace('percentage','target')
-        base_field = field.replace('tmi_','')
-        base_field = base_field.replace('_percentage','')
+    @classmethod
+    def get_top(cls, metric, limit=10, type_=None, parent=None):
+        '''
+        Return the [id, value] of the meta groups of the type under parent
+        with the highest metric for the context
+        '''
+        cls._check_engine(metric)
+        return HierarchyEngine.top(metric, limit=limit, type_=type_,
+            parent=parent)
 
-        target_field_value = getattr(self, target_field,None)
-        base_field_value = getattr(self, base_field,None)
+    @classmethod
+    def get_percentile(cls, metric, percent, type_=None, parent=None):
+        '''
+        Return the percentile of the metric for the context among the meta
+        groups of the type under parent
+        '''
+        cls._check_engine(metric)
+        return HierarchyEngine.percentile(metric, percent, type_=type_,
+            parent=parent)
 
-        difference = 0
-        if target_field_value and target_field_value != 0:
-            difference = base_field_value / target_field_value
-            difference = round(difference, 2)
+    @classmethod
+    def get_attainment(cls, metric, type_=None, parent=None):
+        '''
+        Return for the meta groups of the type under parent the ratio of
+        the metric to its target for the context
+        '''
+        pool = Pool()
+        Configuration = pool.get('tmi.configuration')
+        cls._check_engine(metric)
+        context = Transaction().context
+        start_date = context.get('start_date')
+        end_date = context.get('end_date')
+        months = 1
+        if start_date and end_date:
+            months = diff_month(end_date, start_date)
+        target = Configuration.get_targets()['tmi_%s_target' % metric]
+        return HierarchyEngine.attainment(metric, (target or 0) * months,
+            type_=type_, parent=parent)
 
-        return difference
+    @classmethod
+    def iter_balance_sheet(cls, domain=None, batch=EXPORT_BATCH):
+        '''
+        Yield by batches the rows of EXPORT_FIELDS of the meta groups
+        matching the domain with the balances and targets of the context.
+        The meta groups are read from a server-side cursor on PostgreSQL.
+        '''
+        transaction = Transaction()
+        table = cls.__table__()
+        where = Literal(True)
+        if domain:
+            where = table.id.in_(cls.search(domain, query=True))
+        query = table.select(table.id, table.code, table.name, table.type,
+            table.parent, where=where, order_by=table.left.asc)
+        if backend.name() == 'postgresql':
+            cursor = transaction.connection.cursor('tmi_meta_group_export')
+        else:
+            cursor = transaction.connection.cursor()
+        try:
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                metas = cls.browse([r[0] for r in rows])
+                values = cls.get_balance(metas, BALANCE_FIELDS)
+                values.update(cls.get_target(metas, TARGET_FIELDS))
+                yield [tuple(row) + tuple(
+                        values[n][row[0]] for n in BALANCE_FIELDS)
+                    + tuple(values[n][row[0]] for n in TARGET_FIELDS)
+                    for row in rows]
+        finally:
+            cursor.close()
 
+    @classmethod
+    def export_balance_sheet(cls, file_, format='csv', domain=None):
+        '''
+        Write the balance sheet of the meta groups into the file as CSV
+        or Parquet. The CSV is written into a text file opened with
+        newline=''.
+        '''
+        batches = cls.iter_balance_sheet(domain=domain)
+        if format == 'csv':
+            writer = csv.writer(file_)
+            writer.writerow(EXPORT_FIELDS)
+            for rows in batches:
+                writer.writerows(rows)
+        elif format == 'parquet':
+            if pyarrow is None:
+                cls.raise_user_error('export_missing_pyarrow')
+            schema = pyarrow.schema(
+                [('id', pyarrow.int64()),
+                    ('code', pyarrow.string()),
+                    ('name', pyarrow.string()),
+                    ('type', pyarrow.string()),
+                    ('parent', pyarrow.int64())]
+                + [(n, pyarrow.float64())
+                    for n in BALANCE_FIELDS + TARGET_FIELDS])
+            writer = pyarrow.parquet.ParquetWriter(file_, schema)
+            try:
+                for rows in batches:
+                    columns = [list(c) for c in zip(*rows)]
+                    for i in range(5, len(columns)):
+                        columns[i] = [float(v) for v in columns[i]]
+                    writer.write_table(pyarrow.Table.from_arrays(
+                            [pyarrow.array(c, type=f.type)
+                                for c, f in zip(columns, schema)],
+                            schema=schema))
+            finally:
+                writer.close()
+        else:
+            cls.raise_user_error('export_unknown_format', (format,))
 
 
 class TmiGroup(ActivePeriodMixin, tree(), ModelView, ModelSQL):
@@ -693,26 +1103,32 @@ class TmiGroup(ActivePeriodMixin, tree(), ModelView, ModelSQL):
                 return self.meta.parent.id
         return None
 
-    def get_childs(self, name=None):
-        if self.meta:
-            pool = Pool()
-            Group = pool.get('tmi.group')
-            MetaGroup = pool.get('tmi.meta.group')
-
-            meta_groups = MetaGroup.search([('id','=',self.meta.id)])
-            meta_childs = []
-            if len(meta_groups)==1:
-                meta_childs = meta_groups[0].childs
-            if meta_childs is not []:
-                childs = []
-                for meta in meta_childs:
-                    groups = Group.search([('meta','=',meta.id)])
-                    if len(groups)==1:
-                        childs.append(groups[0].id)
-                return childs
-            return []
-        else:
-            return []
+    @classmethod
+    def _get_meta_childs(cls, meta_ids):
+        '''
+        Return the ids of the TMI groups of the children of each meta group
+        '''
+        pool = Pool()
+        MetaGroup = pool.get('tmi.meta.group')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        meta = MetaGroup.__table__()
+
+        result = dict((i, []) for i in meta_ids)
+        for sub_ids in grouped_slice(meta_ids):
+            cursor.execute(*table.join(meta,
+                    condition=table.meta == meta.id
+                    ).select(meta.parent, table.id,
+                    where=reduce_ids(meta.parent, sub_ids),
+                    order_by=[meta.code.asc, meta.name.asc, table.id.asc]))
+            for parent_id, group_id in cursor.fetchall():
+                result[parent_id].append(group_id)
+        return result
+
+    @classmethod
+    def get_childs(cls, groups, name):
+        childs = cls._get_meta_childs(list({g.meta.id for g in groups}))
+        return dict((g.id, childs[g.meta.id]) for g in groups)
 
     def get_company(self, name=None):
         if self.meta:
@@ -746,28 +1162,13 @@ class TmiGroup(ActivePeriodMixin, tree(), ModelView, ModelSQL):
         self.childs = []
         self.company = Transaction().context.get('company')
         if self.meta:
-            pool = Pool()
-            Group = pool.get('tmi.group')
-            MetaGroup = pool.get('tmi.meta.group')
             self.name = self.meta.name
             self.code = self.meta.code
             self.type = self.meta.type
             self.parent_type = self.meta.parent_type
             self.company = self.meta.company
-            groups = Group.search([('meta','=',self.meta.parent.id)])
-            if len(groups)==1:
-                self.parent = groups[0].id
-            meta_groups = MetaGroup.search([('id','=',self.meta.id)])
-            meta_childs = []
-            if len(meta_groups)==1:
-                meta_childs = meta_groups[0].childs
-            if meta_childs is not []:
-                childs = []
-                for meta in meta_childs:
-                    groups = Group.search([('meta','=',meta.id)])
-                    if len(groups)==1:
-                        childs.append(groups[0].id)
-                self.childs = childs
+            self.parent = self.meta.parent
+            self.childs = self._get_meta_childs([self.meta.id])[self.meta.id]
 
     def get_currency(self, name):
         return self.company.currency.id
@@ -828,6 +1229,20 @@ class TmiGroup(ActivePeriodMixin, tree(), ModelView, ModelSQL):
     def default_company():
         return Transaction().context.get('company')
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Balance = pool.get('tmi.meta.group.balance')
+        actions = iter(args)
+        moved = [g for groups, values in zip(actions, actions)
+            if 'meta' in values for g in groups]
+        before = Balance.get_group_sums(moved) if moved else {}
+        super(TmiGroup, cls).write(*args)
+        if moved:
+            # The snapshots of the closed periods keep the former tree
+            Balance.update_sums(before, Balance.get_group_sums(moved),
+                check_periods=False)
+
     @classmethod
     def get_group_baptism(cls, groups, names):
         '''
@@ -835,6 +1250,8 @@ class TmiGroup(ActivePeriodMixin, tree(), ModelView, ModelSQL):
         '''
         pool = Pool()
         MoveLine = pool.get('tmi.move.line')
+        Balance = pool.get('tmi.meta.group.balance')
+        GroupBalance = pool.get('tmi.group.balance')
         cursor = Transaction().connection.cursor()
 
         result = {}
@@ -844,27 +1261,34 @@ class TmiGroup(ActivePeriodMixin, tree(), ModelView, ModelSQL):
                 raise ValueError('Unknown name: %s' % name)
             result[name] = dict((i, Decimal(0)) for i in ids)
 
-        table = cls.__table__()
-        line = MoveLine.__table__()
-        line_query, fiscalyear_ids = MoveLine.query_get(line)
-        columns = [table.id]
-        for name in names:
-            columns.append(Sum(Coalesce(Column(line, name), 0)))
-        for sub_ids in grouped_slice(ids):
-            red_sql = reduce_ids(table.id, sub_ids)
-            cursor.execute(*table.join(line, 'LEFT',
-                    condition=line.group == table.id
-                    ).select(*columns,
-                    where=red_sql & line_query,
-                    group_by=table.id))
-            for row in cursor.fetchall():
-                group_id = row[0]
-                for i, name in enumerate(names, 1):
-                    # SQLite uses float for SUM
-                    if not isinstance(row[i], Decimal):
-                        result[name][group_id] = Decimal(str(row[i]))
-                    else:
-                        result[name][group_id] = row[i]
+        period_ids = Balance.get_context_periods()
+        if period_ids is not None:
+            # The counters are read when the context is aligned on periods
+            counters = GroupBalance.get_balance(ids, names, period_ids)
+            for name in names:
+                result[name].update(counters[name])
+        else:
+            table = cls.__table__()
+            line = MoveLine.__table__()
+            line_query, fiscalyear_ids = MoveLine.query_get(line)
+            columns = [table.id]
+            for name in names:
+                columns.append(Sum(Coalesce(Column(line, name), 0)))
+            for sub_ids in grouped_slice(ids):
+                red_sql = reduce_ids(table.id, sub_ids)
+                cursor.execute(*table.join(line, 'LEFT',
+                        condition=line.group == table.id
+                        ).select(*columns,
+                        where=red_sql & line_query,
+                        group_by=table.id))
+                for row in cursor.fetchall():
+                    group_id = row[0]
+                    for i, name in enumerate(names, 1):
+                        # SQLite uses float for SUM
+                        if not isinstance(row[i], Decimal):
+                            result[name][group_id] = Decimal(str(row[i]))
+                        else:
+                            result[name][group_id] = row[i]
         for group in groups:
             for name in names:
                 exp = Decimal(str(10.0 ** -group.currency_digits))
@@ -880,46 +1304,14 @@ class TmiGroup(ActivePeriodMixin, tree(), ModelView, ModelSQL):
         organizing_church, praise_thanksgiving, offering for TMI Group.
         '''
         pool = Pool()
-        MoveLine = pool.get('tmi.move.line')
-        cursor = Transaction().connection.cursor()
+        MetaGroup = pool.get('tmi.meta.group')
 
+        metas = list(set(g.meta for g in groups))
+        balances = MetaGroup.get_balance(metas, names)
         result = {}
-        ids = [a.id for a in groups]
         for name in names:
-            if name not in {'baptism','tithe', 'church_planting', \
-                    'gathering','small_group', 'organizing_church', \
-                    'praise_thanksgiving', 'offering'}:
-                raise ValueError('Unknown name: %s' % name)
-            result[name] = dict((i, Decimal(0)) for i in ids)
-
-        table = cls.__table__()
-        line = MoveLine.__table__()
-        #line_query = MoveLine.query_get(line)
-        line_query, fiscalyear_ids = MoveLine.query_get(line)
-
-        columns = [table.id]
-        for name in names:
-            columns.append(Sum(Coalesce(Column(line, name), 0)))
-        for sub_ids in grouped_slice(ids):
-            red_sql = reduce_ids(table.id, sub_ids)
-            cursor.execute(*table.join(line, 'LEFT',
-                    condition=line.group == table.id
-                    ).select(*columns,
-                    where=red_sql & line_query,
-                    group_by=table.id))
-            for row in cursor.fetchall():
-                group_id = row[0]
-                for i, name in enumerate(names, 1):
-                    # SQLite uses float for SUM
-                    if not isinstance(row[i], Decimal):
-                        result[name][group_id] = Decimal(str(row[i]))
-                    else:
-                        result[name][group_id] = row[i]
-        for group in groups:
-            for name in names:
-                exp = Decimal(str(10.0 ** -group.currency_digits))
-                result[name][group.id] = (
-                    result[name][group.id].quantize(exp))
+            result[name] = dict(
+                (g.id, balances[name][g.meta.id]) for g in groups)
         return result
 
 class TmiGroupStatisticalContext(ModelView):
@@ -1030,3 +1422,90 @@ class TmiGroupStatisticalContext(ModelView):
     #                'invisible': ~Eval('comparison', False),
     #                }),
     #        ]
+
+
+class ExportBalanceSheetStart(ModelView):
+    'Export Balance Sheet'
+    __name__ = 'tmi.meta.group.export.start'
+    year = fields.Many2One('tmi.year', 'Year', required=True)
+    from_date = fields.Date('From Date',
+        domain=[
+            If(Eval('to_date') & Eval('from_date'),
+                ('from_date', '<=', Eval('to_date')),
+                ()),
+            ],
+        depends=['to_date'])
+    to_date = fields.Date('To Date',
+        domain=[
+            If(Eval('from_date') & Eval('to_date'),
+                ('to_date', '>=', Eval('from_date')),
+                ()),
+            ],
+        depends=['from_date'])
+    posted = fields.Boolean('Posted Move', help='Show only posted move')
+    format = fields.Selection([
+            ('csv', 'CSV'),
+            ('parquet', 'Parquet'),
+            ], 'Format', required=True)
+
+    @staticmethod
+    def default_year():
+        Year = Pool().get('tmi.year')
+        return Year.find(exception=False)
+
+    @staticmethod
+    def default_posted():
+        return True
+
+    @staticmethod
+    def default_format():
+        return 'csv'
+
+
+class ExportBalanceSheet(Wizard):
+    'Export Balance Sheet'
+    __name__ = 'tmi.meta.group.export'
+    start = StateView('tmi.meta.group.export.start',
+        'tmi.meta_group_export_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', default=True),
+            ])
+    export = StateReport('tmi.meta.group.balance_sheet')
+
+    def do_export(self, action):
+        data = {
+            'company': Transaction().context.get('company'),
+            'year': self.start.year.id,
+            'from_date': self.start.from_date,
+            'to_date': self.start.to_date,
+            'posted': self.start.posted,
+            'format': self.start.format,
+            }
+        return action, data
+
+
+class BalanceSheetReport(Report):
+    'Balance Sheet'
+    __name__ = 'tmi.meta.group.balance_sheet'
+
+    @classmethod
+    def _execute(cls, records, data, action):
+        '''
+        Return the balance sheet written into a temporary file so the
+        wizard session does not hold it
+        '''
+        Meta = Pool().get('tmi.meta.group')
+        format_ = data['format']
+        domain = [('company', '=', data['company'])]
+        with Transaction().set_context(company=data['company'],
+                year=data['year'], from_date=data['from_date'],
+                to_date=data['to_date'], posted=data['posted']), \
+                tempfile.TemporaryFile() as file_:
+            if format_ == 'csv':
+                text = io.TextIOWrapper(file_, encoding='utf-8', newline='')
+                Meta.export_balance_sheet(text, format_, domain=domain)
+                text.detach()
+            else:
+                Meta.export_balance_sheet(file_, format_, domain=domain)
+            file_.seek(0)
+            return format_, file_.read()
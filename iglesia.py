@@ -6,8 +6,12 @@
 
 import datetime 
 from decimal import Decimal
+from sql import Literal
 from trytond.model import ModelView, fields, ModelSQL
 from trytond.pool import PoolMeta, Pool
+from trytond.cache import Cache
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
 from trytond.pyson import Bool, Eval, Not
 from datetime import timedelta, date 
 
@@ -24,6 +28,7 @@ class Iglesia(ModelView, ModelSQL):
     	required=True)
     gps = fields.One2Many('disc.gp','iglesia','Grupos de Esperanza')
     active = fields.Boolean('Activo')
+    _ancestors_cache = Cache('disc.iglesia.ancestors', context=False)
 
     @classmethod
     def __setup__(cls): 
@@ -36,4 +41,67 @@ class Iglesia(ModelView, ModelSQL):
 
     @classmethod
     def delete(cls, records):
-        cls.raise_user_error('delete_records')
\ No newline at end of file
+        cls.raise_user_error('delete_records')
+
+    @classmethod
+    def write(cls, *args):
+        super(Iglesia, cls).write(*args)
+        cls._ancestors_cache.clear()
+
+    @classmethod
+    def get_ancestors(cls, ids):
+        '''
+        Return for each iglesia id the ids of its distrito, zona, campo,
+        union and division and the ids of its active gps
+        '''
+        pool = Pool()
+        Distrito = pool.get('disc.distrito')
+        Zona = pool.get('disc.zona')
+        Campo = pool.get('disc.campo')
+        Union = pool.get('disc.union')
+        Gp = pool.get('disc.gp')
+        iglesia = cls.__table__()
+        distrito = Distrito.__table__()
+        zona = Zona.__table__()
+        campo = Campo.__table__()
+        union = Union.__table__()
+        gp = Gp.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        missing = []
+        for id_ in ids:
+            ancestors = cls._ancestors_cache.get(id_)
+            if ancestors is None:
+                missing.append(id_)
+            else:
+                result[id_] = ancestors
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*iglesia
+                .join(distrito, 'LEFT',
+                    condition=iglesia.distrito == distrito.id)
+                .join(zona, 'LEFT', condition=distrito.zona == zona.id)
+                .join(campo, 'LEFT', condition=zona.campo == campo.id)
+                .join(union, 'LEFT', condition=campo.union == union.id)
+                .join(gp, 'LEFT', condition=(gp.iglesia == iglesia.id)
+                    & (gp.active == Literal(True)))
+                .select(iglesia.id, distrito.id, zona.id, campo.id,
+                    union.id, union.division, gp.id,
+                    where=reduce_ids(iglesia.id, sub_ids),
+                    order_by=[iglesia.id, gp.name, gp.id]))
+            fetched = {}
+            for row in cursor.fetchall():
+                ancestors = fetched.get(row[0])
+                if ancestors is None:
+                    ancestors = fetched[row[0]] = dict(zip(
+                            ['distrito', 'zona', 'campo', 'union',
+                                'division'],
+                            row[1:6]))
+                    ancestors['gps'] = []
+                if row[6] is not None:
+                    ancestors['gps'].append(row[6])
+            for id_, ancestors in fetched.items():
+                ancestors['gps'] = tuple(ancestors['gps'])
+                cls._ancestors_cache.set(id_, ancestors)
+                result[id_] = ancestors
+        return dict((i, a.copy()) for i, a in result.items())
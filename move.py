@@ -1,14 +1,19 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+import csv
 import datetime
-from itertools import groupby, combinations
+import io
+import zipfile
+from xml.etree import ElementTree
+from itertools import groupby, combinations, chain
 from operator import itemgetter
 from collections import defaultdict
 
-from sql import Null, Literal
+from sql import Null, Literal, Values
 from sql.aggregate import Sum, Max
 from sql.conditionals import Coalesce, Case
+from sql.functions import CurrentTimestamp
 
 from trytond.model import (ModelSingleton, DeactivableMixin, 
     ModelView, ModelSQL, DeactivableMixin, fields,
@@ -24,8 +29,12 @@ from trytond.rpc import RPC
 from trytond.tools import reduce_ids, grouped_slice
 from trytond.config import config
 
+from .balance import BALANCE_FIELDS
+from .engine import HierarchyEngine
+
 __all__ = ['Move', 'Line', 
-    'QuoteMove', 'QuoteMoveDefault'
+    'QuoteMove', 'QuoteMoveDefault',
+    'ImportLinesStart', 'ImportLinesResult', 'ImportLines',
     #'CancelMoves', 'CancelMovesDefault',
     #'PrintGeneralJournalStart', 'PrintGeneralJournal', 'GeneralJournal'
     ]
@@ -38,6 +47,9 @@ _LINE_STATES = {
     'readonly': Eval('state') == 'valid',
     }
 _LINE_DEPENDS = ['state']
+IMPORT_CHUNK = 2000
+ODS_TABLE = 'urn:oasis:names:tc:opendocument:xmlns:table:1.0'
+ODS_OFFICE = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
 STATES = [
     ('draft', 'Draft'),
     ('posted', 'Posted'),
@@ -150,6 +162,20 @@ class Move(Workflow, ModelSQL, ModelView):
                     readonly=False, instantiate=0, fresh_session=True),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+
+        super(Move, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Migration: the balances are read from the lines and the rollup
+        table.index_action(['state', 'date', 'period'], 'remove')
+        if backend.name() == 'postgresql':
+            cursor.execute('DROP INDEX IF EXISTS '
+                '"tmi_move_posted_period_date_index"')
+
     @classmethod
     def create(cls, vlist):
         vlist = [x.copy() for x in vlist]
@@ -218,8 +244,14 @@ class Move(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def write(cls, *args):
+        pool = Pool()
+        Line = pool.get('tmi.move.line')
+        Balance = pool.get('tmi.meta.group.balance')
+        GroupBalance = pool.get('tmi.group.balance')
         actions = iter(args)
         all_moves = []
+        balance_moves = []
+        sync_moves = []
         args = []
         for moves, values in zip(actions, actions):
             #keys = list(values.keys())
@@ -230,8 +262,22 @@ class Move(Workflow, ModelSQL, ModelView):
             #    cls.check_modify(moves)
             args.extend((moves, values))
             all_moves.extend(moves)
+            if 'state' in values or 'period' in values:
+                balance_moves.extend(moves)
+            if set(values) & {'date', 'period', 'company', 'state'}:
+                sync_moves.extend(moves)
+        if balance_moves:
+            balance_before = Balance.get_move_sums(balance_moves)
+            group_before = GroupBalance.get_move_sums(balance_moves)
         super(Move, cls).write(*args)
+        if sync_moves:
+            Line.sync_move_fields(sync_moves)
         cls.validate_move(all_moves)
+        if balance_moves:
+            Balance.update_sums(balance_before,
+                Balance.get_move_sums(balance_moves))
+            GroupBalance.update_sums(group_before,
+                GroupBalance.get_move_sums(balance_moves))
 
     @classmethod
     @ModelView.button
@@ -315,67 +361,189 @@ class Move(Workflow, ModelSQL, ModelView):
             new_moves.append(new_move)
         return new_moves
 
+    @classmethod
+    def _get_post_numbers(cls, count):
+        '''
+        Return count numbers of the move sequence reserved in one block
+        '''
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        Config = pool.get('tmi.configuration')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if not count:
+            return []
+        config = Config(1)
+        sequence = config.tmi_move_sequence
+        if sequence.type != 'incremental':
+            return [Sequence.get_id(sequence.id) for _ in range(count)]
+
+        with transaction.set_user(0), \
+                transaction.set_context(user=False, _check_access=False):
+            if backend.name() == 'postgresql' and not Sequence._strict:
+                cursor.execute('SELECT nextval(%s) '
+                    'FROM generate_series(1, %s)',
+                    (sequence._sql_sequence_name, count))
+                numbers = [n for n, in cursor.fetchall()]
+            else:
+                transaction.database.lock(transaction.connection,
+                    Sequence._table)
+                sequence = Sequence(sequence.id)
+                number_next = sequence.number_next_internal
+                increment = sequence.number_increment
+                numbers = [number_next + i * increment
+                    for i in range(count)]
+                Sequence.write([sequence], {
+                        'number_next_internal': (number_next
+                            + count * increment),
+                        })
+
+            date = transaction.context.get('date')
+            prefix = Sequence._process(sequence.prefix, date=date)
+            suffix = Sequence._process(sequence.suffix, date=date)
+        return ['%s%s%s' % (prefix, '%%0%sd' % sequence.padding % n, suffix)
+            for n in numbers]
+
     @classmethod
     @ModelView.button
     def post(cls, moves):
         pool = Pool()
-        Sequence = pool.get('ir.sequence')
         Date = pool.get('ir.date')
         Line = pool.get('tmi.move.line')
-
+        Balance = pool.get('tmi.meta.group.balance')
+        GroupBalance = pool.get('tmi.group.balance')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        line = Line.__table__()
+
+        ids = [m.id for m in moves]
+        not_empty = set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*line.select(line.move,
+                    where=reduce_ids(line.move, sub_ids),
+                    group_by=line.move))
+            not_empty.update(m for m, in cursor.fetchall())
         for move in moves:
-            if not move.lines:
+            if move.id not in not_empty:
                 cls.raise_user_error('post_empty_move', (move.rec_name,))
-            company = None
-            for line in move.lines:
-                if not company:
-                    company = line.group.company
-        for move in moves:
-            move.state = 'posted'
-            if not move.post_number:
-                Sequence = pool.get('ir.sequence')
-                Config = pool.get('tmi.configuration')
-                config = Config(1)
-                move.post_date = Date.today()
-                move.post_number = Sequence.get_id(
-                    config.tmi_move_sequence.id)
+
+        balance_before = Balance.get_move_sums(moves)
+        group_before = GroupBalance.get_move_sums(moves)
         cls.validate_move(moves)
-        cls.save(moves)
+
+        # Number, post date and state are set by a single update
+        to_number = [m.id for m in moves if not m.post_number]
+        numbers = dict(zip(to_number, cls._get_post_numbers(len(to_number))))
+        numbers.update((m.id, m.post_number) for m in moves if m.post_number)
+        today = Date.today()
+        post_date = Case((table.post_number == Null, today),
+            else_=table.post_date)
+        for sub_ids in grouped_slice(ids):
+            sub_numbers = [(i, numbers[i]) for i in sub_ids]
+            columns = [table.state, table.post_number, table.post_date,
+                table.write_uid, table.write_date]
+            if backend.name() == 'postgresql':
+                values = Values(sub_numbers)
+                cursor.execute(*table.update(
+                        columns=columns,
+                        values=['posted', values.column2, post_date,
+                            transaction.user, CurrentTimestamp()],
+                        from_=[values],
+                        where=table.id == values.column1))
+            else:
+                cursor.execute(*table.update(
+                        columns=columns,
+                        values=['posted',
+                            Case(*((table.id == i, n)
+                                    for i, n in sub_numbers)),
+                            post_date, transaction.user, CurrentTimestamp()],
+                        where=reduce_ids(table.id, sub_ids)))
+
+        # Clean the caches as ModelStorage.write does
+        transaction.counter += 1
+        for move in moves:
+            local_cache = move._local_cache.get(move.id)
+            if local_cache:
+                local_cache.clear()
+        for cache in transaction.cache.values():
+            if cls.__name__ in cache:
+                for id_ in ids:
+                    cache[cls.__name__].pop(id_, None)
+
+        Line.sync_move_fields(moves)
+        Balance.update_sums(balance_before, Balance.get_move_sums(moves))
+        GroupBalance.update_sums(group_before,
+            GroupBalance.get_move_sums(moves))
+
+    @classmethod
+    def get_church_lines(cls, church_ids):
+        '''
+        Return for each church meta group id the values of the lines of its
+        active small groups
+        '''
+        pool = Pool()
+        Group = pool.get('tmi.group')
+        MetaGroup = pool.get('tmi.meta.group')
+        group = Group.__table__()
+        meta = MetaGroup.__table__()
+        cursor = Transaction().connection.cursor()
+
+        (_, _, active_query), = Group.search_active('active',
+            ('active', '=', True))
+        result = dict((i, []) for i in church_ids)
+        for sub_ids in grouped_slice(church_ids):
+            cursor.execute(*group.join(meta,
+                    condition=group.meta == meta.id
+                    ).select(meta.parent, group.id,
+                    where=reduce_ids(meta.parent, sub_ids)
+                    & (meta.type == 'small_group')
+                    & (meta.active == Literal(True))
+                    & group.id.in_(active_query),
+                    order_by=[meta.code.asc, meta.name.asc]))
+            for church_id, group_id in cursor.fetchall():
+                values = {'group': group_id}
+                for name in BALANCE_FIELDS:
+                    values[name] = Decimal(0)
+                result[church_id].append(values)
+        return result
+
+    @classmethod
+    def create_church_moves(cls, church_ids, period, date=None):
+        '''
+        Create draft moves of the period for the churches with a line for
+        each of their active small groups
+        '''
+        company_id = Transaction().context.get('company')
+        church_lines = cls.get_church_lines(church_ids)
+        return cls.create([{
+                    'company': company_id,
+                    'group': church_id,
+                    'period': period.id,
+                    'date': date or period.start_date,
+                    'lines': [('create', church_lines[church_id])],
+                    } for church_id in church_ids])
 
     @fields.depends('company','group','lines')
     def on_change_group(self): 
         self.lines = []
         if self.group: 
             pool = Pool()
-            Group = pool.get('tmi.group')
-            MetaGroup = pool.get('tmi.meta.group')
             Line = pool.get('tmi.move.line')
-            meta_groups = MetaGroup.search(['id','=',self.group.id])
             company_id = None
             if self.company: 
                 company_id = self.company.id 
-            if len(meta_groups)==1: 
-                meta_childs = meta_groups[0].childs
             lines_to_add = []
-            for meta_child in meta_childs: 
-                groups = Group.search([('meta','=',meta_child.id)])
-                if len(groups)==1: 
-                    line = Line()
-                    line.group = groups[0].id 
-                    line.baptism = Decimal('0')
-                    line.tithe = Decimal('0')
-                    line.offering = Decimal('0')
-                    line.church_planting = Decimal('0')
-                    line.gathering = Decimal('0')
-                    line.small_group = Decimal('0')
-                    line.organizing_church = Decimal('0')
-                    line.praise_thanksgiving = Decimal('0')
-                    line.state = 'draft'
-                    line.move_state = 'draft'
-                    if company_id: 
-                        line.company = company_id 
-                    lines_to_add.append(line)
-                self.lines = lines_to_add
+            for values in self.get_church_lines(
+                    [self.group.id])[self.group.id]:
+                line = Line(**values)
+                line.state = 'draft'
+                line.move_state = 'draft'
+                if company_id: 
+                    line.company = company_id 
+                lines_to_add.append(line)
+            self.lines = lines_to_add
 
     @classmethod
     def validate(cls, moves):
@@ -506,10 +674,6 @@ class Line(ModelSQL, ModelView):
                 & Bool(Eval('move'))),
             },
         depends=['state'] + _depends)
-    date = fields.Function(fields.Date('Effective Date', required=True,
-            states=_states, depends=_depends),
-            'get_move_field', setter='set_move_field',
-            searcher='search_move_field')
     description = fields.Char('Description', states=_states, depends=_depends)
     move_description = fields.Function(fields.Char('Move Description',
             states=_states, depends=_depends),
@@ -526,18 +690,13 @@ class Line(ModelSQL, ModelView):
         searcher='search_move_field')
     currency_digits = fields.Function(fields.Integer('Currency Digits'),
             'on_change_with_currency_digits')
-    company = fields.Function(fields.Many2One('company.company', 'Company', required=True,
-            ondelete="RESTRICT"),
-        'get_company', searcher='search_company')
-
-    period = fields.Function(fields.Many2One('account.period', 'Period',
-            states=_states, depends=_depends),
-            'get_move_field', setter='set_move_field',
-            searcher='search_move_field')
-    date = fields.Function(fields.Date('Effective Date', required=True,
-            states=_states, depends=_depends),
-            'on_change_with_date', setter='set_move_field',
-            searcher='search_move_field')
+    # date, period, company and posted are copied from the move
+    company = fields.Many2One('company.company', 'Company', readonly=True,
+        select=True, ondelete="RESTRICT")
+    period = fields.Many2One('tmi.period', 'Period', readonly=True,
+        select=True)
+    date = fields.Date('Effective Date', readonly=True, select=True)
+    posted = fields.Boolean('Posted', readonly=True, select=True)
 
     del _states, _depends
 
@@ -556,56 +715,82 @@ class Line(ModelSQL, ModelView):
                     'it is reconciled.'),
                 'move_inactive_group': ('You can not create a move line '
                     'with group "%s" because it is inactive.'),
+                'import_no_code': ('The first row of the file must have a '
+                    '"code" column.'),
+                'import_unknown_code': ('Row %(row)s: there is no active '
+                    'small group with code "%(code)s".'),
+                'import_duplicate_code': ('Row %(row)s: the small group '
+                    '"%(code)s" is already in a previous row.'),
+                'import_invalid_value': ('Row %(row)s: "%(value)s" is not a '
+                    'valid number for "%(field)s".'),
+                'import_move_not_draft': ('Row %(row)s: the move "%(move)s" '
+                    'is not in draft.'),
                 })
     
-    def get_company(self, name=None):
-        if self.move: 
-            return self.move.company.id 
-
     @classmethod
-    def search_company(cls, name, clause):
-        return [('move.' + clause[0],) + tuple(clause[1:])]
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
 
-    def get_move_field(self, name):
-        field = getattr(self.__class__, name)
-        if name.startswith('move_'):
-            name = name[5:]
-        value = getattr(self.move, name)
-        if isinstance(value, ModelSQL):
-            if field._type == 'reference':
-                return str(value)
-            return value.id
-        return value
+        table = TableHandler(cls, module_name)
+        posted_exist = table.column_exist('posted')
 
-    @fields.depends('move', '_parent_move.date')
-    def on_change_with_date(self, name=None):
-        if self.move:
-            return self.move.date
+        super(Line, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        # Migration: copy the move fields to the lines
+        if not posted_exist:
+            cls._update_move_fields()
+
+        table.index_action(['group', 'move', 'state'], 'add')
+        table.index_action(['posted', 'date', 'period'], 'add')
 
     @classmethod
-    def set_move_field(cls, lines, name, value):
-        if name.startswith('move_'):
-            name = name[5:]
-        if not value:
-            return
+    def _update_move_fields(cls, where=None):
         Move = Pool().get('tmi.move')
-        Move.write([line.move for line in lines], {
-                name: value,
-                })
+        line = cls.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
 
-    @classmethod
-    def search_move_field(cls, name, clause):
-        nested = clause[0].lstrip(name)
-        if name.startswith('move_'):
-            name = name[5:]
-        return [('move.' + name + nested,) + tuple(clause[1:])]
+        cursor.execute(*line.update(
+                columns=[line.date, line.period, line.company, line.posted],
+                values=[
+                    move.select(move.date, where=move.id == line.move),
+                    move.select(move.period, where=move.id == line.move),
+                    move.select(move.company, where=move.id == line.move),
+                    move.select(move.state == 'posted',
+                        where=move.id == line.move),
+                    ],
+                where=where))
 
     @classmethod
-    def default_date(cls):
+    def sync_move_fields(cls, moves):
         '''
-        Return today
+        Copy date, period, company and posted state of the moves to their
+        lines
         '''
-        return Pool().get('ir.date').today()
+        to_write = {}
+        for move in moves:
+            key = (move.date, move.period.id if move.period else None,
+                move.company.id if move.company else None,
+                move.state == 'posted')
+            to_write.setdefault(key, []).extend(move.lines)
+        args = []
+        period_ids = set()
+        for (date, period, company, posted), lines in to_write.items():
+            if lines:
+                period_ids.add(period)
+                args.extend((lines, {
+                            'date': date,
+                            'period': period,
+                            'company': company,
+                            'posted': posted,
+                            }))
+        if args:
+            # The copies are written even on posted moves
+            with Transaction().set_context(_tmi_sync_move_fields=True):
+                super(Line, cls).write(*args)
+            # The date is not in the rollup
+            HierarchyEngine.invalidate(period_ids - {None})
 
     @staticmethod
     def default_state():
@@ -729,7 +914,6 @@ class Line(ModelSQL, ModelView):
             return field.convert_order(name, move_tables, Move)
         return staticmethod(order_field)
 
-    order_date = _order_move_field('date')
     order_move_state = _order_move_field('state')
 
     @classmethod
@@ -738,29 +922,24 @@ class Line(ModelSQL, ModelView):
 
 
     @classmethod
-    def query_get(cls, table):
-        
-        #Return SQL clause for move line
-        #depending of the context.
-        #table is the SQL instance of tmi.move.line table
-        
+    def _query_get_where(cls, table, posted, exclude_periods=None):
+        '''
+        Return SQL clause on the date and period columns of table depending
+        of the context and the ids of the years.
+        The periods are resolved up front so the rows are pruned by period.
+        posted is the SQL clause of the posted rows
+        '''
         pool = Pool()
-        
-        Move = pool.get('tmi.move')
         Year = pool.get('tmi.year')
         Period = pool.get('tmi.period')
-
-        move = Move.__table__()
-        year = Year.__table__()
-        period = Period.__table__()
         context = Transaction().context
-        
 
         year_ids = []
+        period_domain = []
         where = Literal(True)
 
         if context.get('posted'):
-            where &= move.state == 'posted'
+            where &= posted
 
         date = context.get('date')
         from_date, to_date = context.get('from_date'), context.get('to_date')
@@ -772,39 +951,76 @@ class Line(ModelSQL, ModelView):
                     ('start_date', '<=', date),
                     ('end_date', '>=', date),
                     ], limit=1)
-            if years:
-                year_id = years[0].id
-            else:
-                year_id = -1
             year_ids = list(map(int, years))
-            where &= period.year == year_id
-            where &= move.date <= date
+            period_domain.append(('year', 'in', year_ids))
+            where &= table.date <= date
         elif year_id or period_ids or from_date or to_date:
             if year_id:
                 year_ids = [year_id]
-                where &= year.id == year_id
+                period_domain.append(('year', '=', year_id))
             if period_ids:
-                where &= move.period.in_(period_ids)
+                period_domain.append(('id', 'in', period_ids))
             if from_date:
-                where &= move.date >= from_date
+                period_domain.append(('end_date', '>=', from_date))
+                where &= table.date >= from_date
             if to_date:
-                where &= move.date <= to_date
+                period_domain.append(('start_date', '<=', to_date))
+                where &= table.date <= to_date
         else:
-            where &= year.state == 'open'
             years = Year.search([
                     ('state', '=', 'open'),
                     ])
             year_ids = list(map(int, years))
+            period_domain.append(('year', 'in', year_ids))
 
-        # Use LEFT JOIN to allow database optimization
-        # if no joined table is used in the where clause.
-        return ((table.state != 'draft')
-            & table.move.in_(move
-                .join(period, 'LEFT', condition=move.period == period.id)
-                .join(year, 'LEFT',
-                    condition=period.year == year.id)
-                .select(move.id, where=where)),
-            year_ids)
+        exclude_periods = set(exclude_periods or [])
+        periods = Period.search(period_domain)
+        where &= reduce_ids(table.period,
+            [p.id for p in periods if p.id not in exclude_periods])
+        return where, year_ids
+
+    @classmethod
+    def query_get(cls, table, exclude_periods=None):
+        
+        #Return SQL clause for move line
+        #depending of the context.
+        #table is the SQL instance of tmi.move.line table
+        #exclude_periods are the ids of periods served from snapshots
+        
+        where, year_ids = cls._query_get_where(table,
+            table.posted == Literal(True), exclude_periods)
+        return (table.state != 'draft') & where, year_ids
+
+    @classmethod
+    def explain_balance(cls, name='baptism'):
+        '''
+        Return the names of the module indexes used by the plan of the meta
+        group balance query for the current context: the line indexes and
+        the tree for unaligned contexts, the rollup and snapshot indexes
+        otherwise.
+        Only PostgreSQL is supported, None is returned for other backends.
+        '''
+        pool = Pool()
+        Meta = pool.get('tmi.meta.group')
+        cursor = Transaction().connection.cursor()
+        if backend.name() != 'postgresql':
+            return None
+
+        query, params = tuple(Meta._balance_query(name))
+        cursor.execute('EXPLAIN ' + query, params)
+        plan = '\n'.join(r[0] for r in cursor.fetchall())
+        return [i for i in (
+                'tmi_move_line_group_move_state_index',
+                'tmi_move_line_posted_date_period_index',
+                'tmi_meta_group_left_index',
+                'tmi_meta_group_right_index',
+                'tmi_meta_group_balance_meta_index',
+                'tmi_meta_group_balance_period_index',
+                'tmi_meta_group_balance_meta_period_posted_uniq',
+                'tmi_meta_group_snapshot_meta_index',
+                'tmi_meta_group_snapshot_period_index',
+                'tmi_meta_group_snapshot_meta_period_posted_uniq',
+                ) if i in plan]
 
     @classmethod
     def on_write(cls, lines):
@@ -813,53 +1029,110 @@ class Line(ModelSQL, ModelView):
     @classmethod
     def validate(cls, lines):
         super(Line, cls).validate(lines)
-        for line in lines:
-            line.check_group()
+        if not Transaction().context.get('_tmi_sync_move_fields'):
+            cls.check_groups(lines)
+
+    @classmethod
+    def check_groups(cls, lines):
+        '''
+        Check with one search that the groups of the lines are active
+        '''
+        Group = Pool().get('tmi.group')
+        groups = Group.search([
+                ('id', 'in', list({l.group.id for l in lines})),
+                ('active', '=', False),
+                ], limit=1)
+        if groups:
+            cls.raise_user_error('move_inactive_group', (
+                    groups[0].rec_name,))
 
     def check_group(self):
-        if not self.group.active:
-            self.raise_user_error('move_inactive_group', (
-                    self.group.rec_name,))
-    
+        self.check_groups([self])
+
+    @classmethod
+    def _get_move_ids(cls, lines):
+        '''
+        Return the ids of the moves of the lines
+        '''
+        line = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        move_ids = set()
+        for sub_ids in grouped_slice([l.id for l in lines]):
+            cursor.execute(*line.select(line.move,
+                    where=reduce_ids(line.id, sub_ids),
+                    group_by=line.move))
+            move_ids.update(m for m, in cursor.fetchall())
+        return list(move_ids)
+
     @classmethod
     def check_modify(cls, lines, modified_fields=None):
         '''
         Check if the lines can be modified
         '''
-        if (modified_fields is not None):
-            return
-        journal_period_done = []
-        for line in lines:
-            if line.move.state == 'posted':
+        Move = Pool().get('tmi.move')
+        line = cls.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice([l.id for l in lines]):
+            cursor.execute(*line.join(move,
+                    condition=line.move == move.id
+                    ).select(move.id,
+                    where=reduce_ids(line.id, sub_ids)
+                    & (move.state == 'posted'),
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
                 cls.raise_user_error('modify_posted_move', (
-                        line.move.rec_name,))
+                        Move(row[0]).rec_name,))
 
     @classmethod
     def delete(cls, lines):
-        Move = Pool().get('tmi.move')
+        pool = Pool()
+        Move = pool.get('tmi.move')
+        Balance = pool.get('tmi.meta.group.balance')
+        GroupBalance = pool.get('tmi.group.balance')
         cls.check_modify(lines)
-        moves = [x.move for x in lines]
+        moves = Move.browse(cls._get_move_ids(lines))
+        balance_before = Balance.get_line_sums(lines)
+        group_before = GroupBalance.get_line_sums(lines)
         super(Line, cls).delete(lines)
         Move.validate_move(moves)
+        Balance.update_sums(balance_before, {})
+        GroupBalance.update_sums(group_before, {})
 
     @classmethod
     def write(cls, *args):
-        Move = Pool().get('tmi.move')
+        pool = Pool()
+        Move = pool.get('tmi.move')
+        Balance = pool.get('tmi.meta.group.balance')
+        GroupBalance = pool.get('tmi.group.balance')
 
         actions = iter(args)
         args = []
-        moves = []
         all_lines = []
+        moved_lines = []
         for lines, values in zip(actions, actions):
             cls.check_modify(lines, set(values.keys()))
-            moves.extend((x.move for x in lines))
             all_lines.extend(lines)
+            if 'move' in values:
+                moved_lines.extend(lines)
             args.extend((lines, values))
 
+        move_ids = set(cls._get_move_ids(all_lines))
+        balance_before = Balance.get_line_sums(all_lines)
+        group_before = GroupBalance.get_line_sums(all_lines)
         super(Line, cls).write(*args)
+        if moved_lines:
+            new_moves = Move.browse(cls._get_move_ids(moved_lines))
+            cls.check_modify(moved_lines)
+            cls.sync_move_fields(new_moves)
+            move_ids.update(m.id for m in new_moves)
 
         Transaction().timestamp = {}
-        Move.validate_move(list(set(l.move for l in all_lines) | set(moves)))
+        Move.validate_move(Move.browse(list(move_ids)))
+        Balance.update_sums(balance_before, Balance.get_line_sums(all_lines))
+        GroupBalance.update_sums(group_before,
+            GroupBalance.get_line_sums(all_lines))
 
     @classmethod
     def create(cls, vlist):
@@ -878,11 +1151,229 @@ class Line(ModelSQL, ModelView):
                 # prevent computation of default date
                 vals.setdefault('date', None)
         lines = super(Line, cls).create(vlist)
-        # Re-browse for cache alignment
-        moves = Move.browse(list(set(line.move for line in lines)))
+        if not Transaction().context.get('_tmi_defer_move_validation'):
+            cls.validate_created(Move.browse(cls._get_move_ids(lines)))
+        return lines
+
+    @classmethod
+    def validate_created(cls, moves):
+        '''
+        Validate the moves with created lines and update the move fields
+        and the balances
+        '''
+        pool = Pool()
+        Move = pool.get('tmi.move')
+        Balance = pool.get('tmi.meta.group.balance')
+        GroupBalance = pool.get('tmi.group.balance')
+        cls.sync_move_fields(moves)
         Move.check_modify(moves)
+        # The created lines are in draft so they are not in the sums yet
+        balance_before = Balance.get_move_sums(moves)
+        group_before = GroupBalance.get_move_sums(moves)
         Move.validate_move(moves)
-        return lines
+        Balance.update_sums(balance_before, Balance.get_move_sums(moves))
+        GroupBalance.update_sums(group_before,
+            GroupBalance.get_move_sums(moves))
+
+    @classmethod
+    def bulk_create(cls, vlists):
+        '''
+        Create the lines of each values list of the iterable and validate
+        all their moves once at the end
+        '''
+        Move = Pool().get('tmi.move')
+        move_ids = set()
+        with Transaction().set_context(_tmi_defer_move_validation=True):
+            for vlist in vlists:
+                move_ids.update(cls._get_move_ids(cls.create(vlist)))
+        if move_ids:
+            cls.validate_created(Move.browse(list(move_ids)))
+
+    @classmethod
+    def _get_import_groups(cls):
+        '''
+        Return for each code of the active small groups of the company the
+        ids of the group and of its church
+        '''
+        pool = Pool()
+        Group = pool.get('tmi.group')
+        MetaGroup = pool.get('tmi.meta.group')
+        group = Group.__table__()
+        meta = MetaGroup.__table__()
+        cursor = Transaction().connection.cursor()
+
+        (_, _, active_query), = Group.search_active('active',
+            ('active', '=', True))
+        cursor.execute(*group.join(meta,
+                condition=group.meta == meta.id
+                ).select(meta.code, group.id, meta.parent,
+                where=(meta.company == Transaction().context.get('company'))
+                & (meta.type == 'small_group')
+                & (meta.active == Literal(True))
+                & (meta.code != Null)
+                & group.id.in_(active_query)))
+        return dict((code.strip(), (group_id, church_id))
+            for code, group_id, church_id in cursor.fetchall())
+
+    @classmethod
+    def _get_import_moves(cls, period, church_ids):
+        '''
+        Return for each church the id, name and state of its move of the
+        period, creating the missing ones in draft
+        '''
+        pool = Pool()
+        Move = pool.get('tmi.move')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        moves = {}
+        for sub_ids in grouped_slice(church_ids):
+            cursor.execute(*move.select(move.group, move.id, move.number,
+                    move.state,
+                    where=(move.period == period.id)
+                    & reduce_ids(move.group, sub_ids)))
+            for church_id, move_id, number, state in cursor.fetchall():
+                moves[church_id] = (move_id, number, state)
+        missing = [c for c in church_ids if c not in moves]
+        if missing:
+            company_id = Transaction().context.get('company')
+            for new_move in Move.create([{
+                            'company': company_id,
+                            'group': church_id,
+                            'period': period.id,
+                            'date': period.start_date,
+                            } for church_id in missing]):
+                moves[new_move.group.id] = (
+                    new_move.id, new_move.number, new_move.state)
+        return moves
+
+    @classmethod
+    def _import_chunk(cls, period, chunk, moves):
+        '''
+        Update the existing lines of the chunk of (row, group, church,
+        values) and return the values of the lines to create and the
+        rejected rows
+        '''
+        line = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        missing = list({c for _, _, c, _ in chunk if c not in moves})
+        if missing:
+            moves.update(cls._get_import_moves(period, missing))
+
+        rejected = []
+        rows = []
+        for number, group_id, church_id, values in chunk:
+            move_id, move_name, state = moves[church_id]
+            if state != 'draft':
+                rejected.append(cls.raise_user_error('import_move_not_draft', {
+                            'row': number,
+                            'move': move_name or move_id,
+                            }, raise_exception=False))
+                continue
+            rows.append((move_id, group_id, values))
+
+        # Update the lines already in the moves like the prefilled ones
+        existing = {}
+        move_ids = list({m for m, _, _ in rows})
+        group_ids = [g for _, g, _ in rows]
+        for sub_ids in grouped_slice(move_ids):
+            cursor.execute(*line.select(line.move, line.group, line.id,
+                    where=reduce_ids(line.move, sub_ids)
+                    & reduce_ids(line.group, group_ids)))
+            for move_id, group_id, line_id in cursor.fetchall():
+                existing[(move_id, group_id)] = line_id
+
+        to_create, to_write = [], []
+        for move_id, group_id, values in rows:
+            line_id = existing.get((move_id, group_id))
+            if line_id:
+                to_write.extend(([cls(line_id)], values))
+            else:
+                values = values.copy()
+                values.update({'move': move_id, 'group': group_id})
+                to_create.append(values)
+        if to_write:
+            cls.write(*to_write)
+        return to_create, rejected
+
+    @classmethod
+    def import_rows(cls, period, rows):
+        '''
+        Import the rows into the draft moves of the period by chunks.
+        The first row is the header with the "code" of the small group and
+        the names of the metrics.
+        Return the number of imported rows and the rejected ones.
+        '''
+        rows = iter(rows)
+        header = [c.strip().lower() for c in next(rows, [])]
+        if 'code' not in header:
+            cls.raise_user_error('import_no_code')
+        code_index = header.index('code')
+        columns = [(i, n) for i, n in enumerate(header)
+            if n in BALANCE_FIELDS]
+
+        groups = cls._get_import_groups()
+        moves = {}
+        rejected = []
+        # Updated by the chunks while bulk_create consumes them
+        counts = {'imported': 0}
+
+        def import_chunk(chunk):
+            to_create, chunk_rejected = cls._import_chunk(
+                period, chunk, moves)
+            rejected.extend(chunk_rejected)
+            counts['imported'] += len(chunk) - len(chunk_rejected)
+            return to_create
+
+        def vlists():
+            seen = set()
+            chunk = []
+            for number, row in enumerate(rows, 2):
+                if not any(c.strip() for c in row):
+                    continue
+                row = row + [''] * (len(header) - len(row))
+                code = row[code_index].strip()
+                if code not in groups:
+                    rejected.append(cls.raise_user_error(
+                            'import_unknown_code', {
+                                'row': number,
+                                'code': code,
+                                }, raise_exception=False))
+                    continue
+                if code in seen:
+                    rejected.append(cls.raise_user_error(
+                            'import_duplicate_code', {
+                                'row': number,
+                                'code': code,
+                                }, raise_exception=False))
+                    continue
+                # Only the columns of the file are written on the existing
+                # lines, the others take their default on the created ones
+                values = {}
+                try:
+                    for i, name in columns:
+                        value = row[i].strip()
+                        values[name] = Decimal(value or 0)
+                except InvalidOperation:
+                    rejected.append(cls.raise_user_error(
+                            'import_invalid_value', {
+                                'row': number,
+                                'value': value,
+                                'field': name,
+                                }, raise_exception=False))
+                    continue
+                seen.add(code)
+                group_id, church_id = groups[code]
+                chunk.append((number, group_id, church_id, values))
+                if len(chunk) >= IMPORT_CHUNK:
+                    yield import_chunk(chunk)
+                    chunk = []
+            if chunk:
+                yield import_chunk(chunk)
+
+        cls.bulk_create(vlists())
+        return counts['imported'], rejected
 
     @classmethod
     def copy(cls, lines, default=None):
@@ -892,6 +1383,56 @@ class Line(ModelSQL, ModelView):
             default['move'] = None
         return super(Line, cls).copy(lines, default=default)
 
+def _read_csv(file_):
+    'Yield the rows of the CSV binary file object while it is read'
+    text = io.TextIOWrapper(file_, encoding='utf-8-sig', newline='')
+    # Sniff the dialect on the first lines and give them back to the reader
+    # so the file does not need to be seekable
+    head, size = [], 0
+    for line in text:
+        head.append(line)
+        size += len(line)
+        if size >= 4096:
+            break
+    try:
+        dialect = csv.Sniffer().sniff(''.join(head), delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    for row in csv.reader(chain(head, text), dialect):
+        yield row
+
+
+def _read_ods(file_):
+    'Yield the rows of the first sheet of the ODS binary file object'
+    table = '{%s}table' % ODS_TABLE
+    table_row = '{%s}table-row' % ODS_TABLE
+    rows_repeated = '{%s}number-rows-repeated' % ODS_TABLE
+    columns_repeated = '{%s}number-columns-repeated' % ODS_TABLE
+    office_value = '{%s}value' % ODS_OFFICE
+    with zipfile.ZipFile(file_) as ods, \
+            ods.open('content.xml') as content:
+        for _, element in ElementTree.iterparse(content):
+            if element.tag == table:
+                return
+            if element.tag != table_row:
+                continue
+            row, empty = [], 0
+            for cell in element:
+                repeat = int(cell.get(columns_repeated, 1))
+                value = cell.get(office_value) or ''.join(cell.itertext())
+                if not value:
+                    # Do not expand the trailing empty cells
+                    empty += repeat
+                    continue
+                row.extend([''] * empty)
+                row.extend([value] * repeat)
+                empty = 0
+            if row:
+                for _ in range(int(element.get(rows_repeated, 1))):
+                    yield row
+            element.clear()
+
+
 class QuoteMove(Wizard):
     'Tmi Quote Move'
     __name__ = 'tmi.move.quote'
@@ -938,3 +1479,61 @@ class QuoteMoveDefault(ModelView):
         
         return description
 
+
+class ImportLinesStart(ModelView):
+    'Import Move Lines'
+    __name__ = 'tmi.move.line.import.start'
+    period = fields.Many2One('tmi.period', 'Period', required=True,
+        domain=[('state', '=', 'open')])
+    file_ = fields.Binary('File', required=True, filename='filename',
+        help='CSV or ODS file with a "code" column for the small group and '
+        'a column for each statistic.')
+    filename = fields.Char('Filename')
+
+    @staticmethod
+    def default_period():
+        Period = Pool().get('tmi.period')
+        return Period.find(exception=False)
+
+
+class ImportLinesResult(ModelView):
+    'Import Move Lines'
+    __name__ = 'tmi.move.line.import.result'
+    imported = fields.Integer('Imported Rows', readonly=True)
+    rejected = fields.Text('Rejected Rows', readonly=True)
+
+
+class ImportLines(Wizard):
+    'Import Move Lines'
+    __name__ = 'tmi.move.line.import'
+    start = StateView('tmi.move.line.import.start',
+        'tmi.move_line_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('tmi.move.line.import.result',
+        'tmi.move_line_import_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_import_(self):
+        Line = Pool().get('tmi.move.line')
+        # Do not keep the file in the wizard session
+        data, self.start.file_ = self.start.file_, None
+        # The rows are parsed from the file while they are imported
+        file_ = io.BytesIO(data)
+        if (self.start.filename or '').lower().endswith('.ods'):
+            rows = _read_ods(file_)
+        else:
+            rows = _read_csv(file_)
+        imported, rejected = Line.import_rows(self.start.period, rows)
+        self.result.imported = imported
+        self.result.rejected = '\n'.join(rejected)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'imported': self.result.imported,
+            'rejected': self.result.rejected,
+            }
@@ -4,8 +4,8 @@
 from dateutil.relativedelta import relativedelta
 from trytond.model import ModelView, ModelSQL, Workflow, fields
 from trytond.wizard import Wizard, StateView, StateAction, Button
-from trytond.tools import datetime_strftime
-from trytond.pyson import Eval, If, PYSONEncoder
+from trytond.tools import datetime_strftime, grouped_slice, reduce_ids
+from trytond.pyson import Eval, If, Bool, PYSONEncoder
 from trytond.transaction import Transaction
 from trytond.pool import Pool
 from trytond.const import OPERATORS
@@ -13,12 +13,15 @@ from trytond.const import OPERATORS
 __all__ = [
     'Year',
     'Period', 
+    'OpenMovesStart',
+    'OpenMoves',
 ]
 
 _STATES = STATES = {
     'readonly': Eval('state') != 'open',
 }
 _DEPENDS = DEPENDS = ['state']
+MOVE_CHUNK = 500
 
 class Year(Workflow, ModelSQL, ModelView):
     'Tmi Year'
@@ -188,7 +191,8 @@ class Year(Workflow, ModelSQL, ModelView):
         '''
         pool = Pool()
         Period = pool.get('tmi.period')
-        
+        Snapshot = pool.get('tmi.meta.group.snapshot')
+
         transaction = Transaction()
         database = transaction.database
         connection = transaction.connection
@@ -207,6 +211,10 @@ class Year(Workflow, ModelSQL, ModelView):
                     ('year', '=', year.id),
                     ])
             Period.close(periods)
+            # Freeze also the periods closed before their snapshots existed
+            frozen = Snapshot.get_frozen_periods(periods)
+            Snapshot.take([p for p in periods
+                    if p.state != 'open' and p.id not in frozen])
 
     @classmethod
     @ModelView.button
@@ -245,6 +253,8 @@ class Period(Workflow, ModelSQL, ModelView):
             ], 'Type', required=True,
         states=_STATES, depends=_DEPENDS, select=True)
     icon = fields.Function(fields.Char("Icon"), 'get_icon')
+    balance_revision = fields.Char('Balance Revision', readonly=True,
+        help='Changed with the balances of the period.')
 
     @classmethod
     def __setup__(cls):
@@ -490,6 +500,43 @@ class Period(Workflow, ModelSQL, ModelView):
         cls._check(periods)
         super(Period, cls).delete(periods)
 
+    @classmethod
+    def create_church_moves(cls, periods, parents=None):
+        '''
+        Create the draft moves of the periods for the churches without one,
+        only under the parents meta groups if set.
+        '''
+        pool = Pool()
+        Move = pool.get('tmi.move')
+        MetaGroup = pool.get('tmi.meta.group')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+        company_id = Transaction().context.get('company')
+
+        domain = [
+            ('type', '=', 'church'),
+            ('active', '=', True),
+            ]
+        if company_id:
+            domain.append(('company', '=', company_id))
+        if parents:
+            domain.append(
+                ('id', 'child_of', [p.id for p in parents], 'parent'))
+        church_ids = [c.id for c in MetaGroup.search(domain, order=[])]
+
+        moves = []
+        for period in periods:
+            existing = set()
+            for sub_ids in grouped_slice(church_ids):
+                cursor.execute(*move.select(move.group,
+                        where=(move.period == period.id)
+                        & reduce_ids(move.group, sub_ids)))
+                existing.update(g for g, in cursor.fetchall())
+            to_create = [c for c in church_ids if c not in existing]
+            for sub_ids in grouped_slice(to_create, MOVE_CHUNK):
+                moves.extend(Move.create_church_moves(list(sub_ids), period))
+        return moves
+
     @classmethod
     @ModelView.button
     @Workflow.transition('close')
@@ -503,17 +550,74 @@ class Period(Workflow, ModelSQL, ModelView):
         # Lock period to be sure no new period will be created in between.
         database.lock(connection, Period._table)
 
-        pass 
+        Snapshot = Pool().get('tmi.meta.group.snapshot')
+        Snapshot.take(periods)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('open')
     def reopen(cls, periods):
         "Re-open period"
-        pass
+        Snapshot = Pool().get('tmi.meta.group.snapshot')
+        Snapshot.drop(periods)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('locked')
     def lock(cls, periods):
-        pass
\ No newline at end of file
+        pass
+
+
+class OpenMovesStart(ModelView):
+    'Open Period Moves'
+    __name__ = 'tmi.period.open_moves.start'
+    period = fields.Many2One('tmi.period', 'Period', required=True,
+        domain=[('state', '=', 'open')])
+    zone = fields.Many2One('tmi.meta.group', 'Zone',
+        domain=[('type', '=', 'zone')])
+    district = fields.Many2One('tmi.meta.group', 'District',
+        domain=[
+            ('type', '=', 'district'),
+            If(Bool(Eval('zone')),
+                ('parent', '=', Eval('zone')),
+                ()),
+            ],
+        depends=['zone'])
+
+    @staticmethod
+    def default_period():
+        context = Transaction().context
+        if context.get('active_model') == 'tmi.period':
+            return context.get('active_id')
+        Period = Pool().get('tmi.period')
+        return Period.find(exception=False)
+
+    @fields.depends('zone', 'district')
+    def on_change_zone(self):
+        if self.district and self.district.parent != self.zone:
+            self.district = None
+
+
+class OpenMoves(Wizard):
+    'Open Period Moves'
+    __name__ = 'tmi.period.open_moves'
+    start = StateView('tmi.period.open_moves.start',
+        'tmi.period_open_moves_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'open_', 'tryton-ok', default=True),
+            ])
+    open_ = StateAction('tmi.act_move_tree')
+
+    def do_open_(self, action):
+        Period = Pool().get('tmi.period')
+        parents = None
+        if self.start.district:
+            parents = [self.start.district]
+        elif self.start.zone:
+            parents = [self.start.zone]
+        moves = Period.create_church_moves([self.start.period],
+            parents=parents)
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', 'in', [m.id for m in moves]),
+                ])
+        return action, {}
@@ -8,6 +8,8 @@ from datetime import timedelta, date
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from trytond.model import ModelStorage, ModelView, fields, ModelSQL, Unique
+from trytond import backend
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Bool, Eval, Not, Id, PYSONEncoder, If, In, Get
 from datetime import timedelta, date 
@@ -15,9 +17,10 @@ from trytond.transaction import Transaction
 from trytond.report import Report
 from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
     StateReport, Button
-from sql import Literal
+from sql import Column, Literal, Null
 from sql.aggregate import Max, Sum, Min, Avg, Count  
 from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
 
 def dummy(numero=None):
     if numero:
@@ -210,6 +213,7 @@ def dummy2(test=None):
 
 __all__ = [
     'Reporte',
+    'ReporteSemana',
     'InformeIglesia',
     'InformeIglesiaContexto',
     'InformeDistrito',
@@ -251,6 +255,9 @@ _YEAR = datetime.datetime.now().year
 _NOW = datetime.datetime.now()
 _START = datetime.datetime.strptime('2017-10-31',"%Y-%m-%d")
 _DOMAIN = []
+# Fields of the reporte copied to its weekly sums
+SEMANA_FIELDS = {'semana', 'fecha_inicio', 'fecha_fin', 'iglesia',
+    'distrito', 'zona', 'campo', 'union'}
 
 class Reporte(ModelView, ModelSQL):
     'Reporte'
@@ -302,10 +309,7 @@ class Reporte(ModelView, ModelSQL):
         'reporte','Bautismos',
         )
     notas = fields.Text('Notas')
-    total = fields.Function(
-        fields.Numeric('Total'), 
-        'get_total' 
-    )
+    total = fields.Numeric('Total', readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -320,10 +324,108 @@ class Reporte(ModelView, ModelSQL):
                 ' registros.',
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        table = TableHandler(cls, module_name)
+        total_exist = table.column_exist('total')
+
+        super(Reporte, cls).__register__(module_name)
+
+        # Migration: total is stored
+        if not total_exist:
+            cls.update_totals()
+        # Migration: reportes without lineas have a zero total
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.update([table.total], [0],
+                where=table.total == Null))
+
+    @classmethod
+    def update_totals(cls, reportes=None):
+        '''
+        Store the sum of the lineas of the reportes or of all the reportes
+        '''
+        pool = Pool()
+        ReporteLinea = pool.get('disc.reporte.linea')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        reporte_linea = ReporteLinea.__table__()
+
+        if reportes is None:
+            # Migration: set-based update of every reporte
+            if backend.name() == 'postgresql':
+                cursor.execute(*table.update([table.total], [0],
+                        where=~table.id.in_(
+                            reporte_linea.select(reporte_linea.reporte,
+                                where=reporte_linea.reporte != Null))))
+                totals = reporte_linea.select(
+                    reporte_linea.reporte.as_('reporte'),
+                    Sum(Coalesce(reporte_linea.cantidad, 0)).as_('total'),
+                    where=reporte_linea.reporte != Null,
+                    group_by=reporte_linea.reporte)
+                cursor.execute(*table.update([table.total], [totals.total],
+                        from_=[totals],
+                        where=table.id == totals.reporte))
+            else:
+                cursor.execute(*table.update([table.total],
+                        [Coalesce(reporte_linea.select(
+                                    Sum(reporte_linea.cantidad),
+                                    where=reporte_linea.reporte == table.id),
+                                0)]))
+            return
+
+        totals = dict((r.id, Decimal(0)) for r in reportes)
+        for sub_ids in grouped_slice(list(totals)):
+            cursor.execute(*reporte_linea.select(reporte_linea.reporte,
+                    Sum(Coalesce(reporte_linea.cantidad, 0)),
+                    where=reduce_ids(reporte_linea.reporte, sub_ids),
+                    group_by=reporte_linea.reporte))
+            for reporte_id, total in cursor.fetchall():
+                # SQLite uses float for SUM
+                if not isinstance(total, Decimal):
+                    total = Decimal(str(total))
+                totals[reporte_id] = total
+        to_write = {}
+        for reporte in cls.browse(list(totals)):
+            if reporte.total != totals[reporte.id]:
+                to_write.setdefault(totals[reporte.id], []).append(reporte)
+        args = []
+        for total, records in to_write.items():
+            args.extend((records, {'total': total}))
+        if args:
+            # The lineas hooks refresh the weekly totals themselves
+            super(Reporte, cls).write(*args)
+
     @classmethod
     def delete(cls, records):
+        # The weekly sums of the reportes would be deleted in cascade
         cls.raise_user_error('delete_records')
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        vlist = [v.copy() for v in vlist]
+        ancestors = Iglesia.get_ancestors(
+            list({v['iglesia'] for v in vlist if v.get('iglesia')}))
+        for values in vlist:
+            iglesia = values.get('iglesia')
+            for name, value in ancestors.get(iglesia, {}).items():
+                if name in cls._fields and not values.get(name):
+                    values[name] = value
+        # The weekly sums are filled by the lineas
+        return super(Reporte, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        reportes = [r for records, values in zip(actions, actions)
+            if set(values) & SEMANA_FIELDS for r in records]
+        super(Reporte, cls).write(*args)
+        if reportes:
+            Pool().get('disc.reporte.semana').refresh(reportes)
+
     @classmethod
     def search_rec_name(cls, name, clause):
         if clause[1].startswith('!') or clause[1].startswith('not '):
@@ -363,41 +465,24 @@ class Reporte(ModelView, ModelSQL):
 
     @fields.depends('iglesia','mes','semana','lineas','distrito','fecha_inicio')
     def on_change_iglesia(self):
-        #print 'Inicio de ciclo'
-        pool = Pool() 
-        gp = pool.get('disc.gp')
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        Linea = pool.get('disc.reporte.linea')
 
-        if self.lineas:
-            lineas = []
-            self.lineas = lineas 
         if self.iglesia:
-            if self.iglesia.distrito: 
-                self.distrito = self.iglesia.distrito.id
-            if self.iglesia.distrito.zona: 
-                self.zona = self.iglesia.distrito.zona.id 
-            if self.iglesia.distrito.zona.campo:
-                self.campo = self.iglesia.distrito.zona.campo.id 
-            if self.iglesia.distrito.zona.campo.union: 
-                self.union = self.iglesia.distrito.zona.campo.union.id 
-            if self.iglesia.distrito.zona.campo.union.division: 
-                self.division = self.iglesia.distrito.zona.campo.union.division.id 
-            
-            id_iglesia = self.iglesia.id 
+            ancestors = Iglesia.get_ancestors([self.iglesia.id])
+            ancestors = ancestors.get(self.iglesia.id, {})
+            gps = ancestors.pop('gps', ())
+            for name, value in ancestors.items():
+                setattr(self, name, value)
 
-            gps = gp.search([('iglesia', '=', id_iglesia)])
-            #print 'Encontrado'+str(gps) 
             lineas = []
-            if gps: 
-                for gp in gps:
-                    Linea = pool.get('disc.reporte.linea')
-                    linea = Linea() 
-                    linea.gp = gp.id 
-                    #linea.lider = gp.lider 
-                    #linea.fecha = Pool().get('ir.date').today()
-                    #linea.iglesia = id_iglesia
-                    linea.cantidad = 0 
-                    lineas.append(linea)
-                self.lineas = lineas 
+            for gp in gps:
+                linea = Linea()
+                linea.gp = gp
+                linea.cantidad = 0
+                lineas.append(linea)
+            self.lineas = lineas
         else:
             self.lineas = []
             self.distrito = self.zona = self.campo = self.union = self.division = None
@@ -415,7 +500,7 @@ class Reporte(ModelView, ModelSQL):
 
     @classmethod
     def default_total(cls):
-        return 0
+        return Decimal(0)
 
     @classmethod
     def default_pastor(cls):
@@ -436,21 +521,163 @@ class Reporte(ModelView, ModelSQL):
 
     @classmethod
     def set_total(cls, reportes):
-        for reporte in reportes:
-            if reporte.lineas:
-                total = 0 
-                for linea in reporte.lineas:
-                    total += getattr(linea, 'cantidad', None) or 0
-                cls.write([reporte], {
-                        'total': total,
-                        })
-
-    def get_total(self, name):
-        total = 0 
-        if self.lineas:
-            for linea in self.lineas:
-                total += getattr(linea, 'cantidad', None) or 0
-        return total 
+        cls.update_totals(reportes)
+
+class ReporteSemana(ModelSQL):
+    'Reporte Semanal'
+    __name__ = 'disc.reporte.semana'
+
+    reporte = fields.Many2One('disc.reporte', 'Reporte', required=True,
+        select=True, ondelete='CASCADE')
+    semana = fields.Char('Semana', required=True)
+    fecha_inicio = fields.Date('Fecha inicio', required=True, select=True)
+    fecha_fin = fields.Date('Fecha fin', required=True, select=True)
+    iglesia = fields.Many2One('disc.iglesia', 'Iglesia', required=True,
+        select=True)
+    gp = fields.Many2One('disc.gp', 'Grupo de Esperanza', required=True,
+        select=True)
+    distrito = fields.Many2One('disc.distrito', 'Distrito', select=True)
+    zona = fields.Many2One('disc.zona', 'Zona', select=True)
+    campo = fields.Many2One('disc.campo', 'Campo', select=True)
+    union = fields.Many2One('disc.union', 'Union', select=True)
+    total = fields.Numeric('Total')
+
+    @classmethod
+    def __setup__(cls):
+        super(ReporteSemana, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('semana_iglesia_gp_unique', Unique(t, t.semana, t.iglesia, t.gp),
+                'Solo puede haber un total por semana, iglesia y grupo.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        created = not TableHandler.table_exist(cls._table)
+
+        super(ReporteSemana, cls).__register__(module_name)
+
+        # Migration: sum the existing reportes
+        if created:
+            cls.refresh()
+
+    @classmethod
+    def refresh(cls, reportes=None):
+        '''
+        Sum again the lineas of the reportes by gp or of all the reportes
+        '''
+        pool = Pool()
+        Reporte = pool.get('disc.reporte')
+        ReporteLinea = pool.get('disc.reporte.linea')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        reporte = Reporte.__table__()
+        reporte_linea = ReporteLinea.__table__()
+
+        if reportes is None:
+            wheres = [Literal(True)]
+        else:
+            wheres = [reduce_ids(reporte.id, sub_ids)
+                for sub_ids in grouped_slice([r.id for r in reportes])]
+        columns = [table.create_uid, table.create_date, table.reporte,
+            table.semana, table.fecha_inicio, table.fecha_fin,
+            table.iglesia, table.distrito, table.zona, table.campo,
+            table.union, table.gp, table.total]
+        for where in wheres:
+            cursor.execute(*table.delete(
+                    where=table.reporte.in_(
+                        reporte.select(reporte.id, where=where))))
+            cursor.execute(*table.insert(columns,
+                    reporte.join(reporte_linea,
+                        condition=reporte_linea.reporte == reporte.id
+                        ).select(Literal(transaction.user),
+                        CurrentTimestamp(), reporte.id, reporte.semana,
+                        reporte.fecha_inicio, reporte.fecha_fin,
+                        reporte.iglesia, reporte.distrito, reporte.zona,
+                        reporte.campo, reporte.union, reporte_linea.gp,
+                        Sum(Coalesce(reporte_linea.cantidad, 0)),
+                        where=where,
+                        group_by=[reporte.id, reporte.semana,
+                            reporte.fecha_inicio, reporte.fecha_fin,
+                            reporte.iglesia, reporte.distrito, reporte.zona,
+                            reporte.campo, reporte.union,
+                            reporte_linea.gp])))
+
+
+# Model and parent field of each level of the informes
+INFORME_LEVELS = {
+    'gp': ('disc.gp', 'iglesia'),
+    'iglesia': ('disc.iglesia', 'distrito'),
+    'distrito': ('disc.distrito', 'zona'),
+    'zona': ('disc.zona', 'campo'),
+    'campo': ('disc.campo', 'union'),
+    }
+
+
+def informe_query(level, active=False, order='total', active_gps=True):
+    '''
+    Return the query of the totals of the weekly sums between the
+    fecha_inicio and fecha_fin of the context for each record of the level
+    under the parent of the context. The id of each row is the id of its
+    record and its active column is the one of the record.
+    If active is set, only the active records are shown when the parent is
+    in the context. If active_gps is set, the lines of inactive gps are not
+    counted. The rows are ordered by descending total or by descending id
+    if order is 'id'.
+    '''
+    pool = Pool()
+    context = Transaction().context
+    model, parent = INFORME_LEVELS[level]
+    Record = pool.get(model)
+    record = Record.__table__()
+    Semana = pool.get('disc.reporte.semana')
+    semana = Semana.__table__()
+    Gp = pool.get('disc.gp')
+    gp = Gp.__table__()
+
+    where = Literal(True)
+    if active_gps:
+        where &= gp.active == Literal(True)
+    if context.get('fecha_inicio'):
+        where &= semana.fecha_inicio >= context['fecha_inicio']
+    if context.get('fecha_fin'):
+        where &= semana.fecha_fin <= context['fecha_fin']
+    if context.get(parent):
+        where &= Column(semana, parent) == context[parent]
+    child = Column(semana, level)
+    totals = (semana
+        .join(gp, condition=semana.gp == gp.id)
+        .select(child.as_('child'),
+            Sum(semana.total).as_('total'),
+            where=where,
+            group_by=child))
+
+    where = Literal(True)
+    if context.get(parent):
+        where &= Column(record, parent) == context[parent]
+        if active:
+            where &= record.active == Literal(True)
+    if order == 'id':
+        order_by = record.id.desc
+    else:
+        order_by = Coalesce(totals.total, 0).desc
+    return (record
+        .join(totals, 'LEFT', condition=record.id == totals.child)
+        .select(
+            record.id.as_('id'),
+            record.create_uid.as_('create_uid'),
+            record.create_date.as_('create_date'),
+            record.write_uid.as_('write_uid'),
+            record.write_date.as_('write_date'),
+            record.id.as_(level),
+            Column(record, parent).as_(parent),
+            record.active.as_('active'),
+            Coalesce(totals.total, 0).as_('total'),
+            where=where,
+            order_by=order_by))
+
 
 class InformeIglesia(ModelSQL, ModelView):
     'Informe por Iglesia'
@@ -464,63 +691,7 @@ class InformeIglesia(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-
-        wheredate = Literal(True)
-        if Transaction().context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= Transaction().context['fecha_inicio']
-        if Transaction().context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= Transaction().context['fecha_fin']
-        if Transaction().context.get('iglesia'):
-            wheredate &= reporte.iglesia == Transaction().context['iglesia']
-
-        subquery = (reporte
-            .join(reporte_linea,
-                condition=reporte_linea.reporte == reporte.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                Max(reporte.iglesia).as_('iglesia'),
-                (reporte_linea.gp).as_('gp'),
-                Sum(reporte_linea.cantidad).as_('total'),
-                where=wheredate,
-                group_by=(reporte_linea.gp),
-                )
-            )
-
-        where = Literal(True)
-        if Transaction().context.get('iglesia'):
-            where &= gp.iglesia == Transaction().context['iglesia']
-            where &= gp.active == True 
-
-        query = (gp
-            .join(subquery,'FULL',
-                condition= gp.id == subquery.gp
-            )
-            .select(
-                Max(gp.id * 1002).as_('id'), 
-                Max(gp.create_uid).as_('create_uid'),
-                Max(gp.create_date).as_('create_date'),
-                Max(gp.write_uid).as_('write_uid'),
-                Max(gp.write_date).as_('write_date'),
-                (Sum( Coalesce(subquery.total,0) )).as_('total'),
-                (gp.id).as_('gp'),
-                where = where, 
-                group_by=(gp.id), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query 
+        return informe_query('gp', active=True, active_gps=False)
 
 class InformeIglesiaContexto(ModelView):
     'Informe Iglesia Contexto'
@@ -595,88 +766,7 @@ class InformeDistrito(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
- 
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Iglesia = pool.get('disc.iglesia')
-        iglesia = Iglesia.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-
-        wheredate = Literal(True)
-        if context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('iglesia'):
-            wheredate &= reporte.iglesia == context['iglesia']
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
-
-        subquery = (reporte
-            .join(query_active, condition=reporte.id==query_active.reporte)
-            #.join(gp,condition=gp.id == reporte_linea.gp)
-            .select(
-                Max(reporte.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                (reporte.iglesia).as_('iglesia'),
-                #reporte.mes,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=wheredate,
-                group_by=[reporte.iglesia])
-            )
-
-        where = Literal(True)
-        if context.get('distrito'):
-            where &= iglesia.distrito == context['distrito']
-            where &= iglesia.active == True 
-            #where &= gp.active == True
-
-        query = (iglesia
-            .join(subquery,'FULL',
-                condition= iglesia.id == subquery.iglesia
-            )
-            #.join(gp, condition= gp.iglesia == iglesia.id)
-            .select(
-                Max(iglesia.id * 1002).as_('id'), 
-                Max(iglesia.create_uid).as_('create_uid'),
-                Max(iglesia.create_date).as_('create_date'),
-                Max(iglesia.write_uid).as_('write_uid'),
-                Max(iglesia.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (iglesia.id).as_('iglesia'),
-                where = where, 
-                group_by=[iglesia.id], 
-                #order_by=Sum(Coalesce(subquery.total,0)).desc,
-                #order_by=Count(Literal(1)).desc, 
-                order_by=iglesia.id.desc, 
-                ) 
-            )
-        return query 
+        return informe_query('iglesia', active=True, order='id')
 
 class InformeDistritoLiderContexto(ModelView):
     'Informe Distrito Contexto'
@@ -826,83 +916,7 @@ class InformeZona(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
- 
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Distrito = pool.get('disc.distrito')
-        distrito = Distrito.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-
-        wheredate = Literal(True)
-        if context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('zona'):
-            wheredate &= reporte.zona == context['zona']
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
-
-        subquery = (reporte
-            .join(query_active,
-                condition=query_active.reporte == reporte.id)
-            .select(
-                Max(reporte.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                (reporte.distrito).as_('distrito'),
-                #reporte.mes,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=wheredate,
-                group_by=[reporte.distrito])
-            )
-
-        where = Literal(True)
-        if context.get('zona'):
-            where &= distrito.zona == context['zona']
-
-        query = (distrito
-            .join(subquery,'FULL',
-                condition= distrito.id == subquery.distrito
-            )
-            .select(
-                Max(distrito.id * 1002).as_('id'), 
-                Max(distrito.create_uid).as_('create_uid'),
-                Max(distrito.create_date).as_('create_date'),
-                Max(distrito.write_uid).as_('write_uid'),
-                Max(distrito.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (distrito.id).as_('distrito'),
-                where = where, 
-                group_by=(distrito.id), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query 
+        return informe_query('distrito')
 
 class InformeZonaContexto(ModelView):
     'Informe Zona Contexto'
@@ -946,84 +960,7 @@ class InformeCampo(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
- 
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Zona = pool.get('disc.zona')
-        zona = Zona.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-
-
-        wheredate = Literal(True)
-        if context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('campo'):
-            wheredate &= reporte.campo == context['campo']
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
-
-        subquery = (reporte
-            .join(query_active,
-                condition=query_active.reporte == reporte.id)
-            .select(
-                Max(reporte.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                (reporte.zona).as_('zona'),
-                #reporte.mes,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=wheredate,
-                group_by=[reporte.zona])
-            )
-
-        where = Literal(True)
-        if context.get('campo'):
-            where &= zona.campo == context['campo']
-
-        query = (zona
-            .join(subquery,'FULL',
-                condition= zona.id == subquery.zona
-            )
-            .select(
-                Max(zona.id * 1002).as_('id'), 
-                Max(zona.create_uid).as_('create_uid'),
-                Max(zona.create_date).as_('create_date'),
-                Max(zona.write_uid).as_('write_uid'),
-                Max(zona.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (zona.id).as_('zona'),
-                where = where, 
-                group_by=(zona.id), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query 
+        return informe_query('zona')
 
 class InformeCampoContexto(ModelView):
     'Informe Campo Contexto'
@@ -1067,83 +1004,7 @@ class InformeUnion(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
- 
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Campo = pool.get('disc.campo')
-        campo = Campo.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-
-        wheredate = Literal(True)
-        if context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('union'):
-            wheredate &= reporte.union == context['union']
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
-
-        subquery = (reporte
-            .join(query_active,
-                condition=query_active.reporte == reporte.id)
-            .select(
-                Max(reporte.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                (reporte.campo).as_('campo'),
-                #reporte.mes,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=wheredate,
-                group_by=[reporte.campo])
-            )
-
-        where = Literal(True)
-        if context.get('union'):
-            where &= campo.union == context['union']
-
-        query = (campo
-            .join(subquery,'FULL',
-                condition= campo.id == subquery.campo
-            )
-            .select(
-                Max(campo.id * 1002).as_('id'), 
-                Max(campo.create_uid).as_('create_uid'),
-                Max(campo.create_date).as_('create_date'),
-                Max(campo.write_uid).as_('write_uid'),
-                Max(campo.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (campo.id).as_('campo'),
-                where = where, 
-                group_by=(campo.id), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query 
+        return informe_query('campo')
 
 class InformeUnionContexto(ModelView):
     'Informe Union Contexto'
@@ -1334,68 +1195,7 @@ class ReporteIglesiaTableGlobal(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-
-        wheredate = Literal(True)
-
-        if context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('iglesia'):
-            wheredate &= reporte.iglesia <= context['iglesia']
-
-        subquery = (reporte
-            .join(reporte_linea,
-                condition=reporte_linea.reporte == reporte.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                #Max(reporte.iglesia).as_('iglesia'),
-                reporte_linea.gp,
-                Sum(reporte_linea.cantidad).as_('total'),
-                where=wheredate,
-                group_by=
-                    (reporte_linea.gp
-                    )
-                )
-            )
-
-        where = Literal(True)
-        if context.get('iglesia'):
-            where &= gp.iglesia == context['iglesia']
-            where &= gp.active == True 
-
-        query = (gp
-            .join(subquery,'FULL',
-                condition= gp.id == subquery.gp
-            )
-            .select(
-                Max(gp.id * 1002).as_('id'), 
-                Max(gp.create_uid).as_('create_uid'),
-                Max(gp.create_date).as_('create_date'),
-                Max(gp.write_uid).as_('write_uid'),
-                Max(gp.write_date).as_('write_date'),
-                (Sum( Coalesce(subquery.total,0) )).as_('total'),
-                (gp.id).as_('gp'),
-                (gp.iglesia).as_('iglesia'),
-                (gp.active),
-                where = where, 
-                group_by=(gp.id, gp.iglesia, gp.active),
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query
+        return informe_query('gp', active=True, active_gps=False)
 
 class ReporteIglesia(Report, ModelSQL):
     'Reporte Iglesia'
@@ -1430,10 +1230,7 @@ class ReporteIglesia(Report, ModelSQL):
         pool = Pool()
 
         Iglesia = pool.get('disc.iglesia')
-        Reporte = pool.get('disc.reporte.iglesia.table.global')
 
-        fecha_inicio = data['fecha_inicio']
-        fecha_fin = data['fecha_fin']
         iglesia = data['iglesia']
         
         iglesia_nombre = ''
@@ -1444,14 +1241,6 @@ class ReporteIglesia(Report, ModelSQL):
                 iglesia_nombre = iglesia.name
                 break
 
-        with Transaction().set_context(
-            fecha_inicio = fecha_inicio,
-            fecha_fin = fecha_fin): 
-            reports = Reporte.search(
-                [('iglesia', '=', iglesia)]
-                #[]
-                )  
-
         report_context['fecha_inicio'] = data['fecha_inicio']
         report_context['fecha_fin'] = data['fecha_fin']
         report_context['fecha'] = data['fecha']
@@ -1460,7 +1249,8 @@ class ReporteIglesia(Report, ModelSQL):
         report_context['pastor'] = data['pastor']
         report_context['distrito'] = data['distrito']
         
-        report_context['total'] = sum((x.total for x in reports))
+        # Only the active rows are counted, as a search does by default
+        report_context['total'] = sum((x.total for x in records))
         
         return report_context
 
@@ -1527,125 +1317,47 @@ class ImprimirReporteDistritoInicio(ModelView):
         #print 'USUARIO: ' + str(User(Transaction().user).groups)
         return user 
 
-    @staticmethod
-    def default_fecha():
-        Date = Pool().get('ir.date')
-        return Date.today()
-
-class ImprimirReporteDistrito(Wizard):
-    'Imprimir Reporte Distrito'
-    __name__ = 'disc.reporte.distrito.imprimir'
-    
-    start = StateView('disc.reporte.distrito.imprimir.inicio',
-        'discipulado.imprimir_reporte_distrito_inicio_form', [
-            Button('Cancelar', 'end', 'tryton-cancel'),
-            Button('Imprimir', 'print_', 'tryton-print', default=True),
-            ])
-    print_ = StateReport('disc.reporte.distrito')
-
-    def do_print_(self, action):
-        data = {
-            'fecha_inicio': self.start.fecha_inicio,
-            'fecha_fin': self.start.fecha_fin,
-            'distrito': self.start.distrito.id,
-            'zona': self.start.distrito.zona.name, 
-            'fecha': self.start.fecha,
-            'usuario': self.start.usuario.name,
-            'pastor': self.start.distrito.pastor.name,
-            }
-        return action, data
-
-class ReporteDistritoTable(ModelSQL, ModelView):
-    'Reporte Distrito Table por GP'
-    __name__ = 'disc.reporte.distrito.table'
-
-    iglesia = fields.Many2One('disc.iglesia',
-        'Iglesia')
-    distrito = fields.Many2One('disc.distrito',
-        'Distrito')
-    total = fields.Numeric('Total')
- 
-    @staticmethod
-    def table_query():
-        pool = Pool()
-        context = Transaction().context
-        Iglesia = pool.get('disc.iglesia')
-        iglesia = Iglesia.__table__()
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-        
-        where = Literal(True)
-        if context.get('fecha_inicio'):
-            where &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            where &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('distrito'):
-            where &= reporte.distrito == context['distrito']
-        #where &= iglesia.active == True 
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
+    @staticmethod
+    def default_fecha():
+        Date = Pool().get('ir.date')
+        return Date.today()
 
-        subquery = (reporte
-            .join(query_active,
-                condition=query_active.reporte == reporte.id)
-            .select(
-                Max(query_active.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                Max(reporte.distrito).as_('distrito'),
-                reporte.iglesia,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=where,
-                group_by=[reporte.iglesia])
-            )
+class ImprimirReporteDistrito(Wizard):
+    'Imprimir Reporte Distrito'
+    __name__ = 'disc.reporte.distrito.imprimir'
+    
+    start = StateView('disc.reporte.distrito.imprimir.inicio',
+        'discipulado.imprimir_reporte_distrito_inicio_form', [
+            Button('Cancelar', 'end', 'tryton-cancel'),
+            Button('Imprimir', 'print_', 'tryton-print', default=True),
+            ])
+    print_ = StateReport('disc.reporte.distrito')
 
-        where = Literal(True)
-        if context.get('distrito'):
-            where &= iglesia.distrito == context['distrito']
-            where &= iglesia.active == True 
+    def do_print_(self, action):
+        data = {
+            'fecha_inicio': self.start.fecha_inicio,
+            'fecha_fin': self.start.fecha_fin,
+            'distrito': self.start.distrito.id,
+            'zona': self.start.distrito.zona.name, 
+            'fecha': self.start.fecha,
+            'usuario': self.start.usuario.name,
+            'pastor': self.start.distrito.pastor.name,
+            }
+        return action, data
 
-        query = (iglesia
-            .join(subquery,'FULL',
-                condition= iglesia.id == subquery.iglesia
-            )
-            .select(
-                Max(iglesia.id * 1002).as_('id'), 
-                Max(iglesia.create_uid).as_('create_uid'),
-                Max(iglesia.create_date).as_('create_date'),
-                Max(iglesia.write_uid).as_('write_uid'),
-                Max(iglesia.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (iglesia.id).as_('iglesia'),
-                (iglesia.distrito).as_('distrito'),
-                where = where, 
-                group_by=(iglesia.id, iglesia.distrito), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query
+class ReporteDistritoTable(ModelSQL, ModelView):
+    'Reporte Distrito Table por GP'
+    __name__ = 'disc.reporte.distrito.table'
+
+    iglesia = fields.Many2One('disc.iglesia',
+        'Iglesia')
+    distrito = fields.Many2One('disc.distrito',
+        'Distrito')
+    total = fields.Numeric('Total')
+ 
+    @staticmethod
+    def table_query():
+        return informe_query('iglesia', active=True)
 
 class ReporteDistrito(Report):
     'Reporte Distrito'
@@ -1683,13 +1395,12 @@ class ReporteDistrito(Report):
         distritos = Distrito.search(['id','=',distrito])
         distrito_name = distritos[0].name
 
+        # The total counts also the inactive iglesias of the distrito
         with Transaction().set_context(fecha_inicio=fecha_inicio,
             fecha_fin=fecha_fin): 
             reports = Reporte.search([
                 ('distrito','=',distrito),
-                ],
-                order=[('total', 'DESC')], 
-                ) 
+                ])
 
         report_context['fecha_inicio'] = data['fecha_inicio']
         report_context['fecha_fin'] = data['fecha_fin']
@@ -1806,85 +1517,7 @@ class ReporteZonaTable(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Distrito = pool.get('disc.distrito')
-        distrito = Distrito.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-        
-        where = Literal(True)
-        if context.get('fecha_inicio'):
-            where &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            where &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('zona'):
-            where &= reporte.zona == context['zona']
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
-
-        subquery = (reporte
-            .join(query_active,
-                condition=query_active.reporte == reporte.id)
-            .select(
-                Max(query_active.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                Max(reporte.zona).as_('zona'),
-                reporte.distrito,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=where,
-                group_by=[reporte.distrito])
-            )
-
-        where = Literal(True)
-        if context.get('zona'):
-            where &= distrito.zona == context['zona']
-            
-
-
-        query = (distrito
-            .join(subquery,'FULL',
-                condition= distrito.id == subquery.distrito
-            )
-            .select(
-                Max(distrito.id * 1002).as_('id'), 
-                Max(distrito.create_uid).as_('create_uid'),
-                Max(distrito.create_date).as_('create_date'),
-                Max(distrito.write_uid).as_('write_uid'),
-                Max(distrito.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (distrito.id).as_('distrito'),
-                (distrito.zona).as_('zona'),
-                where = where, 
-                group_by=(distrito.id, distrito.zona), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query 
+        return informe_query('distrito')
 
 class ReporteZona(Report):
     'Reporte Zona'
@@ -1922,9 +1555,7 @@ class ReporteZona(Report):
             fecha_fin=fecha_fin, zona=zona): 
             reports = Reporte.search([
                 ('zona','=',zona)
-                ],
-                order=[('total', 'DESC')],
-                ) 
+                ])
 
         report_context['fecha_inicio'] = data['fecha_inicio']
         report_context['fecha_fin'] = data['fecha_fin']
@@ -2041,84 +1672,7 @@ class ReporteCampoTable(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
- 
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Zona = pool.get('disc.zona')
-        zona = Zona.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-
-        wheredate = Literal(True)
-        if context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('campo'):
-            wheredate &= reporte.campo == context['campo']
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
-
-        subquery = (reporte
-            .join(query_active,
-                condition=query_active.reporte == reporte.id)
-            .select(
-                Max(reporte.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                (reporte.zona).as_('zona'),
-                #reporte.mes,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=wheredate,
-                group_by=[reporte.zona])
-            )
-
-        where = Literal(True)
-        if context.get('campo'):
-            where &= zona.campo == context['campo']
-
-        query = (zona
-            .join(subquery,'FULL',
-                condition= zona.id == subquery.zona
-            )
-            .select(
-                Max(zona.id * 1002).as_('id'), 
-                Max(zona.create_uid).as_('create_uid'),
-                Max(zona.create_date).as_('create_date'),
-                Max(zona.write_uid).as_('write_uid'),
-                Max(zona.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (zona.id).as_('zona'),
-                (zona.campo),
-                where = where, 
-                group_by=(zona.id,zona.campo), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query 
+        return informe_query('zona')
 
 class ReporteCampo(Report):
     'Reporte Campo'
@@ -2144,21 +1698,11 @@ class ReporteCampo(Report):
     def get_context(cls, records, data):
         report_context = super(ReporteCampo, cls).get_context(records, data)
 
-        Reporte = Pool().get('disc.reporte.campo.table')
         Campo = Pool().get('disc.campo')
 
-        fecha_inicio = data['fecha_inicio']
-        fecha_fin = data['fecha_fin']
         campo = data['campo']
         campos = Campo.search(['id','=',campo])
         campo_name = campos[0].name
-        
-        with Transaction().set_context(fecha_inicio=fecha_inicio,
-            fecha_fin=fecha_fin): 
-            reports = Reporte.search(
-                [('campo','=',campo)],
-                order=[('total', 'DESC')], 
-            ) 
 
         report_context['fecha_inicio'] = data['fecha_inicio']
         report_context['fecha_fin'] = data['fecha_fin']
@@ -2168,7 +1712,7 @@ class ReporteCampo(Report):
         report_context['usuario'] = data['usuario']
         report_context['pastor'] = data['pastor']
         
-        report_context['total'] = sum((x.total for x in reports))
+        report_context['total'] = sum((x.total for x in records))
         
         return report_context
 
@@ -2274,84 +1818,7 @@ class ReporteUnionTable(ModelSQL, ModelView):
  
     @staticmethod
     def table_query():
-        pool = Pool()
-        context = Transaction().context
- 
-        Reporte = pool.get('disc.reporte')
-        reporte = Reporte.__table__()
-        ReporteLinea = pool.get('disc.reporte.linea')
-        reporte_linea = ReporteLinea.__table__()
-        Campo = pool.get('disc.campo')
-        campo = Campo.__table__()
-        Gp = pool.get('disc.gp')
-        gp = Gp.__table__()
-
-        wheredate = Literal(True)
-        if context.get('fecha_inicio'):
-            wheredate &= reporte.fecha_inicio >= context['fecha_inicio']
-        if context.get('fecha_fin'):
-            wheredate &= reporte.fecha_fin <= context['fecha_fin']
-        if context.get('union'):
-            wheredate &= reporte.union == context['union']
-
-        whereactive = Literal(True)
-        whereactive &= gp.active == True 
-
-        query_active = (gp
-            .join(reporte_linea, condition= reporte_linea.gp == gp.id)
-            .select(
-                Max(reporte_linea.id * 1000).as_('id'),
-                Max(reporte_linea.create_uid).as_('create_uid'),
-                Max(reporte_linea.create_date).as_('create_date'),
-                Max(reporte_linea.write_uid).as_('write_uid'),
-                Max(reporte_linea.write_date).as_('write_date'),
-                (reporte_linea.gp).as_('gp'),
-                (reporte_linea.reporte).as_('reporte'),
-                (Sum(reporte_linea.cantidad)).as_('cantidad'),
-                where=whereactive,
-                group_by=[reporte_linea.gp,
-                    reporte_linea.reporte])
-            )
-
-        subquery = (reporte
-            .join(query_active,
-                condition=query_active.reporte == reporte.id)
-            .select(
-                Max(reporte.id * 1000).as_('id'),
-                Max(reporte.create_uid).as_('create_uid'),
-                Max(reporte.create_date).as_('create_date'),
-                Max(reporte.write_uid).as_('write_uid'),
-                Max(reporte.write_date).as_('write_date'),
-                (reporte.campo).as_('campo'),
-                #reporte.mes,
-                (Sum(query_active.cantidad)).as_('total'),
-                where=wheredate,
-                group_by=[reporte.campo])
-            )
-
-        where = Literal(True)
-        if context.get('union'):
-            where &= campo.union == context['union']
-
-        query = (campo
-            .join(subquery,'FULL',
-                condition= campo.id == subquery.campo
-            )
-            .select(
-                Max(campo.id * 1002).as_('id'), 
-                Max(campo.create_uid).as_('create_uid'),
-                Max(campo.create_date).as_('create_date'),
-                Max(campo.write_uid).as_('write_uid'),
-                Max(campo.write_date).as_('write_date'),
-                (Sum(Coalesce(subquery.total,0) )).as_('total'),
-                (campo.id).as_('campo'),
-                (campo.union).as_('union'),
-                where = where, 
-                group_by=(campo.id, campo.union), 
-                order_by=Sum(Coalesce(subquery.total,0)).desc,
-                )
-            )
-        return query 
+        return informe_query('campo')
 
 class ReporteUnion(Report):
     'Reporte Union'
@@ -2378,22 +1845,12 @@ class ReporteUnion(Report):
     def get_context(cls, records, data):
         report_context = super(ReporteUnion, cls).get_context(records, data)
 
-        Reporte = Pool().get('disc.reporte.union.table')
         Union = Pool().get('disc.union')
 
-        fecha_inicio = data['fecha_inicio']
-        fecha_fin = data['fecha_fin']
         union = data['union']
         unions = Union.search(['id','=',union])
         union_name = unions[0].name
 
-        with Transaction().set_context(fecha_inicio=fecha_inicio,
-            fecha_fin=fecha_fin): 
-            reports = Reporte.search(
-                [('union','=',union)],
-                order=[('total', 'DESC')], 
-                ) 
-
         report_context['fecha_inicio'] = data['fecha_inicio']
         report_context['fecha_fin'] = data['fecha_fin']
         report_context['fecha'] = data['fecha']
@@ -2401,6 +1858,6 @@ class ReporteUnion(Report):
         report_context['usuario'] = data['usuario']
         report_context['pastor'] = data['pastor']
         
-        report_context['total'] = sum((x.total for x in reports))
+        report_context['total'] = sum((x.total for x in records))
         
         return report_context
\ No newline at end of file
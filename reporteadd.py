@@ -380,20 +380,8 @@ class ReporteLiderDestacado(Report):
     def get_context(cls, records, data):
         report_context = super(ReporteLiderDestacado, cls).get_context(records, data)
 
-        Reporte = Pool().get('disc.reporte.lider.destacado.table')
-        
-        fecha_inicio = data['fecha_inicio']
-        fecha_fin = data['fecha_fin']
         campo = data['campo']
 
-        with Transaction().set_context(fecha_inicio=fecha_inicio,
-            fecha_fin=fecha_fin): 
-            reports = Reporte.search( 
-                [('campo','=',campo)],
-                order=[('total', 'DESC')], 
-                limit=10, 
-                ) 
-
         report_context['fecha_inicio'] = data['fecha_inicio']
         report_context['fecha_fin'] = data['fecha_fin']
         report_context['fecha'] = data['fecha']
@@ -402,7 +390,7 @@ class ReporteLiderDestacado(Report):
         report_context['usuario'] = data['usuario']
         report_context['pastor'] = data['pastor']
 
-        report_context['total'] = sum((x.total for x in reports))
+        report_context['total'] = sum((x.total for x in records))
         
         return report_context
 
@@ -811,12 +799,9 @@ class ReporteLiderDistrito(Report):
     def get_context(cls, records, data):
         report_context = super(ReporteLiderDistrito, cls).get_context(records, data)
 
-        Reporte = Pool().get('disc.reporte.lider.distrito.table')
         Distrito = Pool().get('disc.distrito')
 
 
-        fecha_inicio = data['fecha_inicio']
-        fecha_fin = data['fecha_fin']
         distrito = data['distrito']
         distrito_name = ''
         distritos = Distrito.search(['id','=',distrito])
@@ -824,14 +809,6 @@ class ReporteLiderDistrito(Report):
             distrito_name = distritos[0].name
 
 
-        with Transaction().set_context(fecha_inicio=fecha_inicio,
-            fecha_fin=fecha_fin,distrito=distrito): 
-            reports = Reporte.search(
-                [],
-                order=[('total','DESC')],
-                #[('distrito','=',distrito)],
-                ) 
-
         report_context['fecha_inicio'] = data['fecha_inicio']
         report_context['fecha_fin'] = data['fecha_fin']
         report_context['fecha'] = data['fecha']
@@ -839,6 +816,7 @@ class ReporteLiderDistrito(Report):
         report_context['distrito'] = distrito_name
         report_context['pastor'] = data['pastor']
 
-        report_context['total'] = sum((x.total for x in reports))
+        # Only the active rows are counted, as a search does by default
+        report_context['total'] = sum((x.total for x in records))
         
         return report_context
\ No newline at end of file
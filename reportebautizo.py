@@ -36,5 +36,38 @@ class ReporteBautizo(ModelView, ModelSQL):
     def default_cantidad(cls):
         return 0 
 
+    @classmethod
+    def create(cls, vlist):
+        lineas = super(ReporteBautizo, cls).create(vlist)
+        cls._update_reporte_totals(lineas)
+        return lineas
+
+    @classmethod
+    def write(cls, *args):
+        lineas = sum(args[0:None:2], [])
+        # The lineas may move to another reporte
+        reportes = {l.reporte for l in lineas if l.reporte}
+        super(ReporteBautizo, cls).write(*args)
+        cls._update_reporte_totals(
+            cls.browse([l.id for l in lineas]), reportes)
+
+    @classmethod
+    def delete(cls, lineas):
+        reportes = {l.reporte for l in lineas if l.reporte}
+        super(ReporteBautizo, cls).delete(lineas)
+        cls._update_reporte_totals([], reportes)
+
+    @classmethod
+    def _update_reporte_totals(cls, lineas, reportes=None):
+        pool = Pool()
+        Reporte = pool.get('disc.reporte')
+        ReporteSemana = pool.get('disc.reporte.semana')
+        reportes = set(reportes or [])
+        reportes.update(l.reporte for l in lineas if l.reporte)
+        if reportes:
+            reportes = list(reportes)
+            Reporte.update_totals(reportes)
+            ReporteSemana.refresh(reportes)
+
         
 
@@ -0,0 +1,8 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+try:
+    from trytond.modules.tmi.tests.test_tmi import suite
+except ImportError:
+    from .test_tmi import suite
+
+__all__ = ['suite']
@@ -0,0 +1,145 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import datetime
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def create_company():
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    Party = pool.get('party.party')
+    Company = pool.get('company.company')
+
+    currency, = Currency.create([{
+                'name': 'Dollar',
+                'code': 'USD',
+                'symbol': '$',
+                }])
+    party, = Party.create([{'name': 'Conference'}])
+    company, = Company.create([{
+                'party': party.id,
+                'currency': currency.id,
+                'type': 'conference',
+                }])
+    return company
+
+
+def create_moves(company, count):
+    'Create count church moves without lines and return them'
+    pool = Pool()
+    Meta = pool.get('tmi.meta.group')
+    Group = pool.get('tmi.group')
+    Year = pool.get('tmi.year')
+    Move = pool.get('tmi.move')
+
+    today = datetime.date.today()
+    year, = Year.create([{
+                'name': str(today.year),
+                'start_date': datetime.date(today.year, 1, 1),
+                'end_date': datetime.date(today.year, 12, 31),
+                }])
+    Year.create_period([year])
+    period = year.periods[0]
+
+    parent, = Meta.create([{
+                'name': 'Conference',
+                'code': 'C',
+                'type': 'conference',
+                'company': company.id,
+                }])
+    for type_ in ['division', 'union', 'field', 'zone', 'district']:
+        parent, = Meta.create([{
+                    'name': type_,
+                    'code': type_,
+                    'type': type_,
+                    'parent': parent.id,
+                    'company': company.id,
+                    }])
+    churches = Meta.create([{
+                'name': 'Church %s' % i,
+                'code': 'CH%s' % i,
+                'type': 'church',
+                'parent': parent.id,
+                'company': company.id,
+                } for i in range(count)])
+    small_groups = Meta.create([{
+                'name': 'Small Group %s' % i,
+                'code': 'SG%s' % i,
+                'type': 'small_group',
+                'parent': church.id,
+                'company': company.id,
+                } for i, church in enumerate(churches)])
+    groups = Group.create([{'meta': m.id} for m in small_groups])
+    moves = Move.create([{
+                'company': company.id,
+                'group': church.id,
+                'period': period.id,
+                'date': period.start_date,
+                } for church in churches])
+    return moves, groups
+
+
+class TmiTestCase(ModuleTestCase):
+    'Test TMI module'
+    module = 'tmi'
+
+    @with_transaction()
+    def test_bulk_create_validate_once(self):
+        'Test bulk_create validates the moves once at the end'
+        pool = Pool()
+        Line = pool.get('tmi.move.line')
+
+        company = create_company()
+        with Transaction().set_context(company=company.id):
+            moves, groups = create_moves(company, 3)
+            vlists = [[{
+                            'move': move.id,
+                            'group': group.id,
+                            'baptism': Decimal(1),
+                            }] for move, group in zip(moves, groups)]
+            with patch.object(Line, 'validate_created',
+                    wraps=Line.validate_created) as validate_created:
+                Line.bulk_create(iter(vlists))
+
+            self.assertEqual(validate_created.call_count, 1)
+            validated, = validate_created.call_args[0]
+            self.assertEqual(sorted(validated), sorted(moves))
+            lines = Line.search([('move', 'in', [m.id for m in moves])])
+            self.assertEqual(len(lines), len(moves))
+            self.assertEqual({l.state for l in lines}, {'valid'})
+
+    @with_transaction()
+    def test_write_line_posted_move(self):
+        'Test the lines of a posted move can not be written'
+        pool = Pool()
+        Move = pool.get('tmi.move')
+        Line = pool.get('tmi.move.line')
+
+        company = create_company()
+        with Transaction().set_context(company=company.id):
+            (move,), (group,) = create_moves(company, 1)
+            line, = Line.create([{
+                        'move': move.id,
+                        'group': group.id,
+                        'baptism': Decimal(1),
+                        }])
+            Move.quote([move])
+            Move.post([move])
+
+            with self.assertRaises(UserError):
+                Line.write([line], {'baptism': Decimal(2)})
+
+
+def suite():
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            TmiTestCase))
+    return suite
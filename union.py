@@ -26,3 +26,10 @@ class Union(ModelView, ModelSQL):
     def __setup__(cls):
         super(Union, cls).__setup__()
         cls._order.insert(0, ('name', 'ASC'))
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        super(Union, cls).write(*args)
+        Iglesia._ancestors_cache.clear()
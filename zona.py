@@ -29,11 +29,18 @@ class Zona(ModelView, ModelSQL):
     def __setup__(cls):
         super(Zona, cls).__setup__()
         cls._order.insert(0, ('name', 'ASC'))  
-    	cls._error_messages.update({
+        cls._error_messages.update({
                 'delete_records': 'Por control interno no puedes borrar'  \
                 ' registros.',
                 })
 
     @classmethod
     def delete(cls, records):
-        cls.raise_user_error('delete_records')
\ No newline at end of file
+        cls.raise_user_error('delete_records')
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Iglesia = pool.get('disc.iglesia')
+        super(Zona, cls).write(*args)
+        Iglesia._ancestors_cache.clear()